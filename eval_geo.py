@@ -1,6 +1,8 @@
 import util
 import sys
 import random
+import collections
+import numpy as np
 
 MARKER_FREQUENCY = 30
 MATCH_DISTANCE = 60
@@ -9,65 +11,74 @@ if len(sys.argv) < 3:
 	print 'usage: eval_geo.py actual.graph inferred.graph'
 	sys.exit(0)
 
-actual = util.read_graph(sys.argv[1])
-inferred = util.read_graph(sys.argv[2])
+actual = util.CSRGraph.read(sys.argv[1])
+inferred = util.CSRGraph.read(sys.argv[2])
 
 def get_markers(graph):
 	# we repeatedly select a random unvisited vertex, do a BFS from the vertex, and put down
 	# markers while searching
-	remaining_vertices = {}
-	for vertex in graph.vertices:
-		remaining_vertices[vertex.id] = vertex
-	search_queue = []
+	remaining_vertices = set(xrange(graph.vertex_count()))
+	isolated = (graph.out_degrees() == 0) & (graph.in_degrees() == 0)
+	isolated = isolated.tolist()
+	xs = graph.xs.tolist()
+	ys = graph.ys.tolist()
+	srcs = graph.edge_src.tolist()
+	lengths = graph.edge_lengths.tolist()
+	out_lists = graph.out_lists()
+	search_queue = collections.deque()
 	markers = []
-	
-	def add_marker_at(point):
-		markers.append(util.PointWithID(len(markers), point.x, point.y, 0))
+
+	def add_marker_at(x, y):
+		markers.append(util.PointWithID(len(markers), x, y, 0))
+
+	def add_marker_along_edge(edge, dst, distance):
+		src = srcs[edge]
+		factor = distance / lengths[edge]
+		add_marker_at(xs[src] + factor * (xs[dst] - xs[src]), ys[src] + factor * (ys[dst] - ys[src]))
 
 	def search_vertex(vertex, remaining_distance):
-		if vertex.id not in remaining_vertices:
+		if vertex not in remaining_vertices:
 			return
-		del remaining_vertices[vertex.id]
-		for edge in vertex.out_edges:
-			if edge.dst.id in remaining_vertices:
-				search_edge_pos(edge, 0, remaining_distance)
+		remaining_vertices.remove(vertex)
+		for edge, dst, _ in out_lists[vertex]:
+			if dst in remaining_vertices:
+				search_edge_pos(edge, dst, 0, remaining_distance)
 
-	def search_edge_pos(edge, distance_along_edge, remaining_distance):
-		if edge.length() > distance_along_edge + remaining_distance:
-			search_queue.append((edge, distance_along_edge + remaining_distance))
-			add_marker_at(edge.point_along_edge(distance_along_edge + remaining_distance))
+	def search_edge_pos(edge, dst, distance_along_edge, remaining_distance):
+		if lengths[edge] > distance_along_edge + remaining_distance:
+			search_queue.append((edge, dst, distance_along_edge + remaining_distance))
+			add_marker_along_edge(edge, dst, distance_along_edge + remaining_distance)
 		else:
-			search_vertex(edge.dst, distance_along_edge + remaining_distance - edge.length())
+			search_vertex(dst, distance_along_edge + remaining_distance - lengths[edge])
 
-	while len(remaining_vertices) > 0:
-		search_queue = []
-		vertex = random.choice(remaining_vertices.values())
-		if len(vertex.out_edges) == 0 and len(vertex.in_edges) == 0:
-			del remaining_vertices[vertex.id]
+	# visiting vertices in a random order and skipping visited ones is the same as picking
+	# a random unvisited vertex each round, but touches every vertex only once
+	order = range(graph.vertex_count())
+	random.shuffle(order)
+	for vertex in order:
+		if vertex not in remaining_vertices:
+			continue
+		search_queue.clear()
+		if isolated[vertex]:
+			remaining_vertices.remove(vertex)
 			continue
-		add_marker_at(vertex)
+		add_marker_at(xs[vertex], ys[vertex])
 		search_vertex(vertex, MARKER_FREQUENCY)
 		while len(search_queue) > 0:
-			edge, distance_along_edge = search_queue[0]
-			search_queue = search_queue[1:]
-			search_edge_pos(edge, distance_along_edge, MARKER_FREQUENCY)
+			edge, dst, distance_along_edge = search_queue.popleft()
+			search_edge_pos(edge, dst, distance_along_edge, MARKER_FREQUENCY)
 	
 	return markers
 
 actual_markers = get_markers(actual)
 inferred_markers = get_markers(inferred)
-actual_index = util.Index(actual_markers)
-actual_matched_set = set()
-inferred_matched_set = set()
-for marker in inferred_markers:
-	candidates = actual_index.nearby(marker, MATCH_DISTANCE)
-	candidates = [candidate for candidate in candidates if marker.distance_to(candidate) < MATCH_DISTANCE]
-	if candidates:
-		for candidate in candidates:
-			actual_matched_set.add(candidate.id)
-		inferred_matched_set.add(marker.id)
-precision = float(len(inferred_matched_set)) / float(len(inferred_markers))
-recall = float(len(actual_matched_set)) / float(len(actual_markers))
+actual_index = util.Index(actual_markers, backend='grid', cell_size=MATCH_DISTANCE)
+offsets, matches, _ = actual_index.nearby_many(inferred_markers, MATCH_DISTANCE)
+# index slots are positions in actual_markers, so each matched marker is counted once
+actual_matched_count = len(np.unique(matches))
+inferred_matched_count = np.count_nonzero(offsets[1:] > offsets[:-1])
+precision = float(inferred_matched_count) / float(len(inferred_markers))
+recall = float(actual_matched_count) / float(len(actual_markers))
 if precision + recall > 0:
 	score = 2 * precision * recall / (precision + recall)
 else:
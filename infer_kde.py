@@ -1,29 +1,32 @@
 import cv
-from math import atan2,sqrt,ceil,pi
+import numpy as np
 import sys,getopt,os
-from infer_kde_lib import TripLoader
+from infer_kde_lib import TripLoader, MapGrid, TILE_SIZE, rasterize_trips, map_cache_path, build_map_cache, open_map_cache, blur_maps, threshold_map, sector_support
+from util import list_trace_files
 from pylibs import spatialfunclib
-from itertools import tee, izip
+from itertools import izip
 
 if len(sys.argv) < 2:
-    print "Usage: infer_kde.py trip_dir [-c <cell_size>] [-t <mask_threshold>] [-b <gaussian_blur_size>] [-s <voronoi_sampling_interval>] [-d <shave_until_fraction>] [-n <max_trips>] [-h]\n"
+    print "Usage: infer_kde.py trip_dir [-c <cell_size>] [-t <mask_threshold>] [-b <gaussian_blur_size>] [-s <voronoi_sampling_interval>] [-d <shave_until_fraction>] [-n <max_trips>] [-p <processes>] [-q] [-h]\n"
     sys.exit()
 
-all_trips = TripLoader.get_all_trips(sys.argv[1])
+trip_count = len(list_trace_files(sys.argv[1]))
 
 ##
 ## important parameters
 ##
 
 cell_size = 2 # meters
-mask_threshold = int(len(all_trips) * 0.05) # turns grayscale into binary
+mask_threshold = int(trip_count * 0.05) # turns grayscale into binary
 gaussian_blur = 17
 voronoi_sampling_interval = 10 # sample one point every so many pixels along the outline
 MIN_DIR_COUNT = 10
 shave_until = 0.9999
-trip_max = len(all_trips)
+trip_max = trip_count
+processes = None # threads used for smoothing, None uses every CPU
+debug_images = True # write the intermediate images, -q turns this off
 
-opts,args = getopt.getopt(sys.argv[2:],"c:t:b:s:hn:d:")
+opts,args = getopt.getopt(sys.argv[2:],"c:t:b:s:hn:d:p:q")
 for o,a in opts:
     if o == "-c":
         cell_size=int(a)
@@ -37,35 +40,28 @@ for o,a in opts:
         shave_until = float(a)
     elif o == "-n":
         trip_max = int(a)
+    elif o == "-p":
+        processes = int(a)
+    elif o == "-q":
+        debug_images = False
     elif o == "-h":
-        print "Usage: infer_kde.py trip_dir [-c <cell_size>] [-t <mask_threshold>] [-b <gaussian_blur_size>] [-s <voronoi_sampling_interval>] [-d <shave_until_fraction>] [-n <max_trips>] [-h]\n"
+        print "Usage: infer_kde.py trip_dir [-c <cell_size>] [-t <mask_threshold>] [-b <gaussian_blur_size>] [-s <voronoi_sampling_interval>] [-d <shave_until_fraction>] [-n <max_trips>] [-p <processes>] [-q] [-h]\n"
         sys.exit()
 
-# 0 = North, 2 = East, 4 = South, 6 = West
-def getsector(fromx,fromy,tox,toy):
-    angle = atan2(toy-fromy,tox-fromx)
-    # subtract pi/8 to align better with cardinal directions
-    return int(-angle/(pi/4)+2) % 8
-
-def pairwise(iterable):
-    "s -> (s0,s1), (s1,s2), (s2, s3), ..."
-    a, b = tee(iterable)
-    next(b, None)
-    return izip(a, b)
+# only the first trip_max trip files are parsed
+all_trips = TripLoader.get_all_trips(sys.argv[1], max_trips=trip_max)
 
 ##
 ## initialize some globals and read in the trips
 ##
 
-all_locations = reduce(lambda x,y: x+y,[t.locations for t in all_trips[:trip_max]])
-all_x = [l.x for l in all_locations]
-all_y = [l.y for l in all_locations]
+bounds = all_trips[:trip_max].bounds()
 
 # find bounding box for data
-min_x = min(all_x)-300
-max_x = max(all_x)+300
-min_y = min(all_y)-300
-max_y = max(all_y)+300
+min_x = bounds.min_point.x-300
+max_x = bounds.max_point.x+300
+min_y = bounds.min_point.y-300
+max_y = bounds.max_point.y+300
 
 diff_x = max_x - min_x
 diff_y = max_y - min_y
@@ -76,82 +72,32 @@ width = int(diff_x / cell_size)
 height = int(diff_y / cell_size)
 xscale = width / diff_x # pixels per x
 yscale = height / diff_y # pixels per y
-
-# aggregate intensity map for all traces
-themap = cv.CreateMat(height,width,cv.CV_16UC1)
-cv.SetZero(themap)
-
-# aggregate intensity map for all traces, split by sector heading
-sector_maps = {}
+grid = MapGrid(min_x, min_y, width, height, xscale, yscale)
 
 ##
 ## Build an aggregate intensity map from all the edges
 ##
 
-filename = "cache/n%d_c%d.xml"%(trip_max,cell_size)
-if os.access(filename,os.F_OK) and False:
-    print "Found cached intensity map %s, loading."%(filename)
-    themap = cv.Load(filename)
-    for sector in range(8):
-        sector_maps[sector]=cv.Load("cache/n%d_c%d_s%d.xml"%(trip_max,cell_size,sector))
+# the maps only depend on the trips, trip_max and cell_size, so runs that tune the later
+# stages reuse them. They are tiled and memory-mapped from the cache, so only the tiles
+# that trips cross are ever allocated, however large the bounding box.
+# themap is the aggregate intensity map for all traces, sector_maps[i] the one for
+# traces heading in sector i
+cache_path = map_cache_path("cache", sys.argv[1], trip_max, cell_size)
+cached_maps = open_map_cache(cache_path)
+if cached_maps is not None:
+    print "Found cached intensity map %s, loading."%(cache_path)
+    themap, sector_maps = cached_maps
 else:
-    print "Making new intensity map %s."%(filename)
-    sector_temp = {}
-    sector_temp2 = {}
-    for sector in range(8):
-        sector_maps[sector]=cv.CreateMat(height,width,cv.CV_16UC1)
-        cv.SetZero(sector_maps[sector])
-        sector_temp[sector]=cv.CreateMat(height,width,cv.CV_8UC1)
-        cv.SetZero(sector_temp[sector])
-        sector_temp2[sector]=cv.CreateMat(height,width,cv.CV_16UC1)
-        cv.SetZero(sector_temp2[sector])
-
-    for trip in all_trips[:trip_max]:
-        temp = cv.CreateMat(height,width,cv.CV_8UC1)
-        cv.SetZero(temp)
-        temp16 = cv.CreateMat(height,width,cv.CV_16UC1)
-        cv.SetZero(temp16)
-
-        for (orig,dest) in pairwise(trip.locations):
-            oy=height-int(yscale*(orig.y - min_y))
-            ox=int(xscale*(orig.x - min_x))
-            dy=height-int(yscale*(dest.y - min_y))
-            dx=int(xscale*(dest.x - min_x))
-            cv.Line(temp,(ox,oy),(dx,dy),(32),1,cv.CV_AA)
-
-            sector = getsector(ox,oy,dx,dy)
-            cv.Line(sector_temp[sector],(ox,oy),(dx,dy),(32),1,cv.CV_AA)
-
-        # accumulate trips into themap
-        cv.ConvertScale(temp,temp16,1,0);
-        cv.Add(themap,temp16,themap);
-
-        # accumulate sector-separated trips into sector_maps
-        for sector in range(8):
-            cv.ConvertScale(sector_temp[sector],sector_temp2[sector],1,0);
-            cv.Add(sector_maps[sector],sector_temp2[sector],sector_maps[sector])
-            sector_temp[sector]=cv.CreateMat(height,width,cv.CV_8UC1)
-            cv.SetZero(sector_temp[sector])
-        
-    print("filename here:" + filename)
-    new_filename = "/Users/lesian/6808_lab4/" + filename
-    # cv.Save(filename,themap)
-    # cv.Save(new_filename,themap)
-    for sector in range(8):
-        #cv.Save("cache/n%d_c%d_s%d.xml"%(trip_max,cell_size,sector),sector_maps[sector])
-        pass
-
-    lines = cv.CreateMat(height,width,cv.CV_8U)
-    cv.SetZero(lines)
-    for trip in all_trips:
-        for (orig,dest) in pairwise(trip.locations):
-            oy=height-int(yscale*(orig.y - min_y))
-            ox=int(xscale*(orig.x - min_x))
-            dy=height-int(yscale*(dest.y - min_y))
-            dx=int(xscale*(dest.x - min_x))
-            cv.Line(lines,(ox,oy),(dx,dy),(255),1,cv.CV_AA)
-    cv.SaveImage("lines.png",lines)
+    print "Making new intensity map %s."%(cache_path)
+    # each trip adds at most 32 to a pixel, in themap and in the map of its heading
+    themap, sector_maps = build_map_cache(cache_path, all_trips[:trip_max], grid)
 
+    # lines.png only changes with the trips, so cached runs keep the one drawn here
+    if debug_images:
+        lines_map, _ = rasterize_trips(all_trips, grid, value=255, sectors=False, tile_size=TILE_SIZE)
+        lines = cv.fromarray(np.minimum(lines_map.to_dense(), 255).astype(np.uint8))
+        cv.SaveImage("lines.png",lines)
 
 print "Intensity map acquired."
 
@@ -161,15 +107,30 @@ print "Intensity map acquired."
 ## Processing of intensity map below this line
 ##
 
-def sector_count(line):
-    (orig,dest)=line
-    sector = getsector(orig[0],orig[1],dest[0],dest[1])
-    li = cv.InitLineIterator(sector_maps[sector],orig,dest,8)
-    li2 = cv.InitLineIterator(sector_maps[(sector+1)%8],orig,dest,8)
-    li3 = cv.InitLineIterator(sector_maps[(sector+7)%8],orig,dest,8)
-    return sum(li)+sum(li2)+sum(li3)
+def classify_lines(candidates):
+    # counts for all the candidate edges in both directions, in one pass over the maps
+    forward_counts, reverse_counts = sector_support(sector_maps, [line[0] for line in candidates], [line[1] for line in candidates])
+    lines = []
+    for line, forward_count, reverse_count in izip(candidates, forward_counts.tolist(), reverse_counts.tolist()):
+        reverse_line = (line[1],line[0])
+
+        # if the count is within a factor of 4, we consider the road bi-directional
+        if min(forward_count,reverse_count)>0 and max(forward_count,reverse_count) / min(forward_count,reverse_count) < 4:
+            lines.append(line)
+            lines.append(reverse_line)
+        # if we don't have a count in either direction, the edge is probably a bit crooked.
+        # include it as a bi-directional edge - it'll wash out on a long street
+        elif forward_count <= MIN_DIR_COUNT and reverse_count <= MIN_DIR_COUNT:
+            lines.append(line)
+            lines.append(reverse_line)
+        elif forward_count>reverse_count:
+            lines.append(line)
+        else:
+                lines.append(reverse_line)
+    return lines
 
 def draw_subdiv_facet( img, contour, edge ):
+    # returns the facet's edges inside the contour; classify_lines picks their directions
     lines = []
     t = cv.Subdiv2DGetEdge( edge, cv.CV_NEXT_AROUND_LEFT );
     last_t = None
@@ -206,23 +167,7 @@ def draw_subdiv_facet( img, contour, edge ):
                 return test_edge(seq.h_next(),adding,level+1)
 
         if pt!=pt2 and test_edge(contour,False,0):
-            forward_count = sector_count(line)
-            reverse_line = (line[1],line[0])
-            reverse_count = sector_count(reverse_line)
-
-            # if the count is within a factor of 4, we consider the road bi-directional
-            if min(forward_count,reverse_count)>0 and max(forward_count,reverse_count) / min(forward_count,reverse_count) < 4:
-                lines.append(line)
-                lines.append(reverse_line)
-            # if we don't have a count in either direction, the edge is probably a bit crooked.
-            # include it as a bi-directional edge - it'll wash out on a long street
-            elif forward_count <= MIN_DIR_COUNT and reverse_count <= MIN_DIR_COUNT:
-                lines.append(line)
-                lines.append(reverse_line)
-            elif forward_count>reverse_count:
-                lines.append(line)
-            else:
-                    lines.append(reverse_line)
+            lines.append(line)
 
             t = cv.Subdiv2DGetEdge( t, cv.CV_NEXT_AROUND_LEFT );
 
@@ -264,6 +209,9 @@ def paint_voronoi( subdiv, contour, img ):
         if counter % 100 == 0:
             print '... do {} so far'.format(counter)
 
+    print "Classifying {} edges".format(len(lines))
+    lines = classify_lines(lines)
+
     print "Shaving lines"
     while len(lines) > 0:
         oldsize = len(lines)
@@ -282,7 +230,8 @@ def paint_voronoi( subdiv, contour, img ):
         else:
             seen_lines[line]=1
 
-        cv.Line( img, line[0], line[1], (255,0,0),1,cv.CV_AA);
+        if img is not None:
+            cv.Line( img, line[0], line[1], (255,0,0),1,cv.CV_AA);
         if not line[0] in vertex_ids:
             vertex_ids[line[0]]=vertex_id
             vertices_by_id.append(line[0])
@@ -301,17 +250,15 @@ def paint_voronoi( subdiv, contour, img ):
 
 # synthetic data - draw two antialiased lines and add these onto the main map
 
-for sector in range(8):
-    mask = cv.CreateMat(height,width,cv.CV_8U)
-    cv.SetZero(mask)
-    cv.Smooth(sector_maps[sector], sector_maps[sector], cv.CV_GAUSSIAN, gaussian_blur,gaussian_blur)
-    cv.ConvertScale(sector_maps[sector],mask,1,0);
-    cv.SaveImage("sector"+`sector`+".png",mask)
+# the nine blurs are independent, so their tiles are all smoothed in one thread pool
+blurred = blur_maps(sector_maps + [themap], gaussian_blur, processes)
+sector_maps, themap = blurred[:8], blurred[8]
+if debug_images:
+    for sector in range(8):
+        mask = cv.fromarray(np.minimum(sector_maps[sector].to_dense(), 255).astype(np.uint8))
+        cv.SaveImage("sector"+`sector`+".png",mask)
 # # create the mask and compute the contour
 
-mask = cv.CreateMat(height,width,cv.CV_8U)
-cv.SetZero(mask)
-
 # histogram creation
 #temp = cv.CreateMat(height,width,cv.CV_32FC1) #cv.CV_8UC1)
 #cv.SetZero(temp)
@@ -321,26 +268,35 @@ cv.SetZero(mask)
 #cv.Pow(temp,temp2,0.5)
 #cv.SaveImage("histogram.png",temp2)
 
-cv.Smooth(themap, themap, cv.CV_GAUSSIAN, gaussian_blur,gaussian_blur)
-cv.SaveImage("map.png",themap)
-(minval,maxval,minloc,maxloc)=cv.MinMaxLoc(themap)
+(minval,maxval)=(float(themap.min()),float(themap.max()))
 print "Min: "+`minval`+" max: "+`maxval`
-cv.ConvertScale(themap,mask,255.0/maxval,0);
-cv.SaveImage("mask.png",mask)
-cv.CmpS(themap,mask_threshold,mask,cv.CV_CMP_GT)
-cv.SaveImage("thresholded.png",mask)
+if debug_images:
+    cv.SaveImage("map.png",cv.fromarray(themap.to_dense()))
+    scaled = themap.map_tiles(lambda window: np.minimum(np.rint(window*(255.0/maxval)), 255), 0, np.uint8)
+    cv.SaveImage("mask.png",cv.fromarray(scaled.to_dense()))
+thresholded = threshold_map(themap, mask_threshold)
+if debug_images:
+    cv.SaveImage("thresholded.png",cv.fromarray(thresholded.to_dense()))
+# contours are only found over the tiles holding road pixels, with a blank pixel of
+# margin so that no contour touches the edge of the mask; offset maps them back to the grid
+(mask_row,mask_col,mask_height,mask_width) = thresholded.occupied_bounds()
+mask = cv.fromarray(thresholded.window(mask_row-1,mask_col-1,mask_height+2,mask_width+2))
 
 #contour = cv.FindContours(mask,cv.CreateMemStorage(),cv.CV_RETR_CCOMP,cv.CV_CHAIN_APPROX_SIMPLE)
-chain = cv.FindContours(mask,cv.CreateMemStorage(),cv.CV_RETR_CCOMP,cv.CV_CHAIN_CODE)
+chain = cv.FindContours(mask,cv.CreateMemStorage(),cv.CV_RETR_CCOMP,cv.CV_CHAIN_CODE,(mask_col-1,mask_row-1))
 contour = cv.ApproxChains(chain,cv.CreateMemStorage(),cv.CV_CHAIN_APPROX_NONE,0,100,1)
 
-img = cv.CreateMat(height,width,cv.CV_8UC3)
-cv.SetZero(img)
-cv.DrawContours(img,contour,(255,255,255),(0,255,0),6,1)
-cv.SaveImage("contours.png",img)
+if debug_images:
+    img = cv.CreateMat(height,width,cv.CV_8UC3)
+    cv.SetZero(img)
+    cv.DrawContours(img,contour,(255,255,255),(0,255,0),6,1)
+    cv.SaveImage("contours.png",img)
 
-img = cv.CreateMat(height,width,cv.CV_8UC3)
-cv.SetZero(img)
+# the voronoi image is as large as the whole grid, so it is only drawn for debugging
+img = None
+if debug_images:
+    img = cv.CreateMat(height,width,cv.CV_8UC3)
+    cv.SetZero(img)
 
 # # create the voronoi graph
 
@@ -364,8 +320,10 @@ print "Calculating Voronoi"
 cv.CalcSubdivVoronoi2D( delaunay );
 print "Done calculating Voronoi"
 print 'drawing contours'
-cv.DrawContours(img,contour,(255,255,255),(0,0,255),6,1)
+if img is not None:
+    cv.DrawContours(img,contour,(255,255,255),(0,0,255),6,1)
 print 'painting voronoi'
 paint_voronoi(delaunay,contour,img)
-print 'saving image'
-cv.SaveImage("voronoi.png",img)
+if img is not None:
+    print 'saving image'
+    cv.SaveImage("voronoi.png",img)
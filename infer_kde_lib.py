@@ -0,0 +1,639 @@
+'''
+Trip loading and intensity map construction for infer_kde.py.
+
+Trips are read with the loader in util.py, so a trip is a StoredTrace whose
+coordinates() are slices of one columnar TraceStore.
+'''
+from util import TraceStore, iter_traces, read_traces, list_trace_files, trace_files_key
+import numpy as np
+from multiprocessing.pool import ThreadPool
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import shutil
+
+# value each trip adds to a pixel it crosses
+TRIP_INTENSITY = 32
+# trips rasterized together; bounds the memory used for pixel samples
+RASTER_CHUNK = 256
+# side of the square tiles of a TiledMap, in pixels
+TILE_SIZE = 256
+# bumped whenever the rasterized maps or their layout on disk would come out differently
+MAP_CACHE_VERSION = 2
+
+class TripLoader(object):
+	@staticmethod
+	def get_all_trips(trips_path, max_trips=None, pattern='*', processes=None, cache_dir='cache'):
+		'''
+		Returns a TraceStore with the trips in trips_path.
+
+		The first call parses the trips across a process pool and saves them as a trace pack
+		in cache_dir; later calls memory-map the pack until the trip files change.
+		'''
+		return read_traces(trips_path, pattern, max_trips, processes, cache_dir)
+
+	@staticmethod
+	def iter_trips(trips_path, max_trips=None, pattern='*', processes=None):
+		'''
+		Yields trips from trips_path one at a time as they are parsed.
+		'''
+		return iter_traces(trips_path, pattern, max_trips, processes)
+
+class MapGrid(object):
+	def __init__(self, min_x, min_y, width, height, xscale, yscale):
+		'''
+		The pixel grid of the intensity maps.
+
+		A point (x, y) falls on column int(xscale * (x - min_x)) and row
+		height - int(yscale * (y - min_y)), so that north is up.
+		'''
+		self.min_x = min_x
+		self.min_y = min_y
+		self.width = width
+		self.height = height
+		self.xscale = xscale
+		self.yscale = yscale
+
+	def pixels(self, xs, ys):
+		'''
+		Returns the (cols, rows) integer arrays of the pixels of points.
+		'''
+		cols = np.trunc(self.xscale * (xs - self.min_x)).astype(np.int64)
+		rows = self.height - np.trunc(self.yscale * (ys - self.min_y)).astype(np.int64)
+		return cols, rows
+
+def get_sectors(from_cols, from_rows, to_cols, to_rows):
+	'''
+	Returns the heading sector of segments in pixel coordinates, with 0 = North,
+	2 = East, 4 = South and 6 = West.
+	'''
+	angles = np.arctan2(to_rows - from_rows, to_cols - from_cols)
+	return np.trunc(-angles / (math.pi / 4) + 2).astype(np.int64) % 8
+
+def segment_samples(from_cols, from_rows, to_cols, to_rows):
+	'''
+	Returns the pixels covered by line segments between pixel centers, as arrays
+	(segments, cols, rows, weights).
+
+	A segment is sampled once per pixel along its major axis. Each sample falls between
+	two pixels across the minor axis and covers them in proportion to its distance from
+	each, as in an antialiased line; segments[i] tells which segment sample i belongs to.
+	'''
+	dcols = to_cols - from_cols
+	drows = to_rows - from_rows
+	steps = np.maximum(np.abs(dcols), np.abs(drows))
+	counts = steps + 1
+	segments = np.repeat(np.arange(len(steps)), counts)
+	starts = np.cumsum(counts) - counts
+	positions = np.arange(counts.sum()) - starts[segments]
+	# dividing after multiplying keeps the major axis coordinate exact
+	divisors = np.maximum(steps, 1).astype(np.float64)[segments]
+	cols = from_cols[segments] + positions * dcols[segments] / divisors
+	rows = from_rows[segments] + positions * drows[segments] / divisors
+
+	# one of cols and rows is whole at every sample, so flooring both and sharing the
+	# remainder splits the sample between two pixels across the minor axis
+	low_cols = np.floor(cols)
+	low_rows = np.floor(rows)
+	remainders = (cols - low_cols) + (rows - low_rows)
+	across_cols = (np.abs(dcols) < np.abs(drows))[segments].astype(np.int64)
+	low_cols = low_cols.astype(np.int64)
+	low_rows = low_rows.astype(np.int64)
+	segments = np.concatenate([segments, segments])
+	cols = np.concatenate([low_cols, low_cols + across_cols])
+	rows = np.concatenate([low_rows, low_rows + 1 - across_cols])
+	weights = np.concatenate([1 - remainders, remainders])
+	covered = weights > 0
+	return segments[covered], cols[covered], rows[covered], weights[covered]
+
+class TiledMap(object):
+	def __init__(self, height, width, tile_size=TILE_SIZE, dtype=np.uint16, directory=None):
+		'''
+		A height x width map stored as square tiles of tile_size pixels. Tiles are only
+		allocated where the map is written to, and the rest of the map reads as zero, so
+		memory follows the area that traces cover rather than the bounding box.
+
+		If directory is set, new tiles are created there as memory-mapped .npy files, so
+		the map need not fit in memory; this is the layout that save writes and load reads.
+		'''
+		self.height = height
+		self.width = width
+		self.tile_size = tile_size
+		self.dtype = np.dtype(dtype)
+		self.directory = directory
+		self.tiles = {}
+		# tiles on disk that have not been opened yet, see load
+		self.tile_files = {}
+		self.mmap_mode = None
+		if directory is not None:
+			self._write_header(directory)
+
+	def _write_header(self, directory):
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		with open(os.path.join(directory, 'map.json'), 'w') as f:
+			json.dump({'height': self.height, 'width': self.width, 'tile_size': self.tile_size, 'dtype': self.dtype.str}, f)
+
+	@staticmethod
+	def _tile_fname(directory, key):
+		return os.path.join(directory, 'tile_{}_{}.npy'.format(*key))
+
+	@staticmethod
+	def load(directory, mmap_mode='c'):
+		'''
+		Opens a map written by save, or built with a directory.
+
+		Tiles are opened only when first used, memory-mapped with mmap_mode; with the
+		default copy-on-write mode, changes to them are never written back.
+		'''
+		with open(os.path.join(directory, 'map.json')) as f:
+			header = json.load(f)
+		tiled = TiledMap(header['height'], header['width'], header['tile_size'], header['dtype'])
+		tiled.mmap_mode = mmap_mode
+		for fname in os.listdir(directory):
+			if fname.startswith('tile_') and fname.endswith('.npy'):
+				row, col = fname[len('tile_'):-len('.npy')].split('_')
+				tiled.tile_files[(int(row), int(col))] = os.path.join(directory, fname)
+		return tiled
+
+	@staticmethod
+	def from_array(array, tile_size=TILE_SIZE):
+		'''
+		Returns a TiledMap with the contents of a dense 2D array, leaving out empty tiles.
+		'''
+		tiled = TiledMap(array.shape[0], array.shape[1], tile_size, array.dtype)
+		for key in tiled.all_keys():
+			window = tiled._window_of(array, key)
+			if window.any():
+				tiled.set_tile(key, window)
+		return tiled
+
+	def save(self, directory):
+		'''
+		Writes the map into directory as a header and one .npy file per allocated tile.
+		'''
+		self._write_header(directory)
+		for key in self.keys():
+			np.save(self._tile_fname(directory, key), self.tile(key))
+
+	def flush(self):
+		'''
+		Writes changes to memory-mapped tiles back to their files.
+		'''
+		for tile in self.tiles.itervalues():
+			if isinstance(tile, np.memmap):
+				tile.flush()
+
+	def tile_rows(self):
+		return (self.height + self.tile_size - 1) // self.tile_size
+
+	def tile_cols(self):
+		return (self.width + self.tile_size - 1) // self.tile_size
+
+	def all_keys(self):
+		'''
+		Returns the (tile row, tile column) key of every tile of the map, allocated or not.
+		'''
+		return [(row, col) for row in xrange(self.tile_rows()) for col in xrange(self.tile_cols())]
+
+	def keys(self):
+		'''
+		Returns the keys of the allocated tiles, in row-major order.
+		'''
+		return sorted(set(self.tiles) | set(self.tile_files))
+
+	def tile(self, key, create=False):
+		'''
+		Returns the tile_size x tile_size array of tile key, or None if it is not allocated
+		and create is False. Pixels of edge tiles beyond the map are never used.
+		'''
+		if key in self.tiles:
+			return self.tiles[key]
+		if key in self.tile_files:
+			self.tiles[key] = np.load(self.tile_files.pop(key), mmap_mode=self.mmap_mode)
+			return self.tiles[key]
+		if not create:
+			return None
+		shape = (self.tile_size, self.tile_size)
+		if self.directory is None:
+			tile = np.zeros(shape, dtype=self.dtype)
+		else:
+			tile = np.lib.format.open_memmap(self._tile_fname(self.directory, key), mode='w+', dtype=self.dtype, shape=shape)
+		self.tiles[key] = tile
+		return tile
+
+	def set_tile(self, key, values):
+		'''
+		Sets the contents of tile key from an array of up to tile_size x tile_size values.
+		'''
+		tile = self.tile(key, create=True)
+		tile[:values.shape[0], :values.shape[1]] = values
+
+	def _window_of(self, array, key):
+		row, col = key[0] * self.tile_size, key[1] * self.tile_size
+		return array[row:row + self.tile_size, col:col + self.tile_size]
+
+	def _group_by_tile(self, rows, cols):
+		'''
+		Yields (key, positions) for the tiles holding the given pixels, where positions
+		selects the pixels in that tile.
+		'''
+		ids = (rows // self.tile_size) * self.tile_cols() + cols // self.tile_size
+		order = np.argsort(ids, kind='mergesort')
+		ids = ids[order]
+		bounds = np.flatnonzero(np.diff(ids)) + 1
+		for start, end in zip(np.concatenate([[0], bounds]).tolist(), np.concatenate([bounds, [len(ids)]]).tolist()):
+			if start < end:
+				yield divmod(int(ids[start]), self.tile_cols()), order[start:end]
+
+	def add(self, rows, cols, values):
+		'''
+		Adds values to the pixels at rows and cols, which must be distinct pixels of the
+		map, saturating at the largest value of the map's dtype.
+		'''
+		limit = np.iinfo(self.dtype).max if self.dtype.kind in 'ui' else np.inf
+		for key, positions in self._group_by_tile(rows, cols):
+			tile = self.tile(key, create=True)
+			tile_rows = rows[positions] % self.tile_size
+			tile_cols = cols[positions] % self.tile_size
+			tile[tile_rows, tile_cols] = np.minimum(tile[tile_rows, tile_cols] + values[positions], limit)
+
+	def values_at(self, rows, cols):
+		'''
+		Returns the values of the pixels at rows and cols, with 0 for pixels off the map.
+		'''
+		rows = np.asarray(rows, dtype=np.int64)
+		cols = np.asarray(cols, dtype=np.int64)
+		values = np.zeros(len(rows), dtype=self.dtype)
+		inside = np.flatnonzero((rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width))
+		for key, positions in self._group_by_tile(rows[inside], cols[inside]):
+			tile = self.tile(key)
+			if tile is not None:
+				positions = inside[positions]
+				values[positions] = tile[rows[positions] % self.tile_size, cols[positions] % self.tile_size]
+		return values
+
+	def window(self, row, col, height, width):
+		'''
+		Returns a dense copy of the height x width region whose top left pixel is at row and
+		col; the region may extend beyond the map, which reads as zero.
+		'''
+		window = np.zeros((height, width), dtype=self.dtype)
+		first_row, last_row = max(row, 0), min(row + height, self.height)
+		first_col, last_col = max(col, 0), min(col + width, self.width)
+		if first_row >= last_row or first_col >= last_col:
+			return window
+		for tile_row in xrange(first_row // self.tile_size, (last_row - 1) // self.tile_size + 1):
+			for tile_col in xrange(first_col // self.tile_size, (last_col - 1) // self.tile_size + 1):
+				tile = self.tile((tile_row, tile_col))
+				if tile is None:
+					continue
+				top, left = tile_row * self.tile_size, tile_col * self.tile_size
+				r0, r1 = max(first_row, top), min(last_row, top + self.tile_size)
+				c0, c1 = max(first_col, left), min(last_col, left + self.tile_size)
+				window[r0 - row:r1 - row, c0 - col:c1 - col] = tile[r0 - top:r1 - top, c0 - left:c1 - left]
+		return window
+
+	def occupied_bounds(self):
+		'''
+		Returns (row, col, height, width) of the smallest region covering every allocated
+		tile, so that window(*occupied_bounds()) holds every nonzero pixel of the map.
+		'''
+		keys = self.keys()
+		if not keys:
+			return 0, 0, 0, 0
+		rows = [key[0] for key in keys]
+		cols = [key[1] for key in keys]
+		row, col = min(rows) * self.tile_size, min(cols) * self.tile_size
+		return row, col, min((max(rows) + 1) * self.tile_size, self.height) - row, min((max(cols) + 1) * self.tile_size, self.width) - col
+
+	def to_dense(self):
+		'''
+		Returns the whole map as a dense array.
+		'''
+		return self.window(0, 0, self.height, self.width)
+
+	def map_tiles(self, function, halo=0, dtype=None, pool=None):
+		'''
+		Returns a new in-memory TiledMap with function applied tile by tile.
+
+		function receives a dense window of the map around one tile, with halo extra
+		pixels on every side, and returns an array of the same shape whose center is the
+		new tile. It is applied to the allocated tiles and to the tiles within halo of
+		them; all other tiles, and results that are all zero, stay unallocated, so function
+		must map an all-zero window to zero.
+
+		If pool is set, tiles are processed concurrently with its map method, so
+		function must be safe to call from several threads at once.
+		'''
+		result = TiledMap(self.height, self.width, self.tile_size, self.dtype if dtype is None else dtype)
+		reach = (halo + self.tile_size - 1) // self.tile_size
+		keys = set()
+		for row, col in self.keys():
+			for tile_row in xrange(max(row - reach, 0), min(row + reach + 1, self.tile_rows())):
+				for tile_col in xrange(max(col - reach, 0), min(col + reach + 1, self.tile_cols())):
+					keys.add((tile_row, tile_col))
+		keys = sorted(keys)
+
+		def apply(key):
+			window = self.window(key[0] * self.tile_size - halo, key[1] * self.tile_size - halo, self.tile_size + 2 * halo, self.tile_size + 2 * halo)
+			return function(window)[halo:halo + self.tile_size, halo:halo + self.tile_size]
+
+		if pool is None:
+			tiles = itertools.imap(apply, keys)
+		else:
+			# open every tile up front, as tile is not safe to call concurrently
+			for key in self.keys():
+				self.tile(key)
+			tiles = pool.map(apply, keys)
+		for key, values in itertools.izip(keys, tiles):
+			if values.any():
+				result.set_tile(key, values)
+		return result
+
+	def max(self):
+		return max([self.tile(key).max() for key in self.keys()] or [0])
+
+	def min(self):
+		minimum = min([self.tile(key).min() for key in self.keys()] or [0])
+		# unallocated tiles are zero
+		if len(self.keys()) < self.tile_rows() * self.tile_cols():
+			minimum = min(minimum, 0)
+		return minimum
+
+def _deduplicated_sums(groups, pixels, values, size):
+	'''
+	Returns (pixels, sums): the distinct pixels and, for each, the sum over groups of the
+	largest value the group has at that pixel. size bounds the pixel numbers.
+	'''
+	keys = groups * size + pixels
+	order = np.lexsort((values, keys))
+	keys = keys[order]
+	# the last entry of each run of equal keys holds the largest value
+	last = np.append(keys[1:] != keys[:-1], True)
+	pixels = pixels[order][last]
+	values = values[order][last]
+	unique_pixels, inverse = np.unique(pixels, return_inverse=True)
+	return unique_pixels, np.bincount(inverse, weights=values)
+
+def _add_to_map(target, width, pixels, sums):
+	'''
+	Adds sums to a dense array or TiledMap at the flat pixel numbers pixels.
+	'''
+	if isinstance(target, TiledMap):
+		target.add(pixels // width, pixels % width, sums)
+	else:
+		flat = target.ravel()
+		flat[pixels] = np.minimum(flat[pixels] + sums, np.iinfo(target.dtype).max)
+
+def rasterize_trips(trips, grid, value=TRIP_INTENSITY, sectors=True, chunk_size=RASTER_CHUNK, tile_size=None, directory=None):
+	'''
+	Draws every segment of trips onto intensity maps on grid.
+
+	Returns (themap, sector_maps): themap is a uint16 array of shape (height, width), and
+	sector_maps a uint16 array of shape (8, height, width) with the segments of each
+	heading sector (see get_sectors), or None if sectors is False.
+
+	If tile_size is set, the maps are TiledMaps instead, and sector_maps a list of eight;
+	with directory also set, they are memory-mapped in its subdirectories map and
+	sector0 to sector7.
+
+	Each trip adds up to value to every pixel it covers, however many of its segments
+	cover it, in themap and in the map of each sector it covers the pixel in. Work and
+	memory scale with the length of the trips in pixels rather than with the map area:
+	trips are processed chunk_size at a time, and only covered pixels are touched.
+	'''
+	if not isinstance(trips, TraceStore):
+		trips = TraceStore.from_traces(trips)
+	size = grid.height * grid.width
+	if tile_size is None:
+		themap = np.zeros((grid.height, grid.width), dtype=np.uint16)
+		sector_maps = np.zeros((8, grid.height, grid.width), dtype=np.uint16) if sectors else None
+	else:
+		def new_map(name):
+			return TiledMap(grid.height, grid.width, tile_size, np.uint16, None if directory is None else os.path.join(directory, name))
+		themap = new_map('map')
+		sector_maps = [new_map('sector{}'.format(sector)) for sector in range(8)] if sectors else None
+
+	for first in xrange(0, len(trips), chunk_size):
+		chunk = trips[first:first + chunk_size]
+		xs, ys, _ = chunk.columns()
+		offsets = chunk.offsets - chunk.offsets[0]
+		cols, rows = grid.pixels(xs, ys)
+
+		# segment j joins points j and j + 1 and belongs to a trip unless it joins two
+		segment_trips = np.repeat(np.arange(len(chunk)), np.maximum(np.diff(offsets) - 1, 0))
+		inside = np.ones(max(len(xs) - 1, 0), dtype=bool)
+		starts = offsets[1:-1]
+		inside[starts[(starts > 0) & (starts < len(xs))] - 1] = False
+		from_cols, to_cols = cols[:-1][inside], cols[1:][inside]
+		from_rows, to_rows = rows[:-1][inside], rows[1:][inside]
+
+		segments, sample_cols, sample_rows, weights = segment_samples(from_cols, from_rows, to_cols, to_rows)
+		on_map = (sample_cols >= 0) & (sample_cols < grid.width) & (sample_rows >= 0) & (sample_rows < grid.height)
+		if not on_map.any():
+			continue
+		segments = segments[on_map]
+		pixels = sample_rows[on_map] * grid.width + sample_cols[on_map]
+		values = np.rint(weights[on_map] * value)
+		sample_trips = segment_trips[segments]
+		_add_to_map(themap, grid.width, *_deduplicated_sums(sample_trips, pixels, values, size))
+		if sectors:
+			# sectors are told apart by numbering their pixels in separate ranges
+			sample_sectors = get_sectors(from_cols, from_rows, to_cols, to_rows)[segments]
+			sector_pixels, sums = _deduplicated_sums(sample_trips, sample_sectors * size + pixels, values, 8 * size)
+			for sector in range(8):
+				selected = sector_pixels // size == sector
+				_add_to_map(sector_maps[sector], grid.width, sector_pixels[selected] - sector * size, sums[selected])
+	return themap, sector_maps
+
+def gaussian_kernel(size):
+	'''
+	Returns the normalized 1D Gaussian kernel of odd length size used by OpenCV's
+	Gaussian smoothing, with sigma = 0.3 * ((size - 1) * 0.5 - 1) + 0.8.
+	'''
+	sigma = 0.3 * ((size - 1) * 0.5 - 1) + 0.8
+	offsets = np.arange(size) - (size - 1) / 2.0
+	kernel = np.exp(-offsets ** 2 / (2 * sigma ** 2))
+	return kernel / kernel.sum()
+
+def gaussian_blur(array, size):
+	'''
+	Returns array smoothed with a size x size Gaussian kernel, as a float64 array of the
+	same shape.
+
+	The kernel is applied as two 1D passes, and pixels beyond the array read as zero.
+	'''
+	kernel = gaussian_kernel(size)
+	radius = size // 2
+	result = np.asarray(array, dtype=np.float64)
+	for axis in (0, 1):
+		padded = np.pad(result, [(radius, radius) if a == axis else (0, 0) for a in (0, 1)], 'constant')
+		result = np.zeros(array.shape)
+		for offset, weight in enumerate(kernel.tolist()):
+			if axis == 0:
+				result += weight * padded[offset:offset + array.shape[0]]
+			else:
+				result += weight * padded[:, offset:offset + array.shape[1]]
+	return result
+
+def blur_map(tiled, size, pool=None):
+	'''
+	Returns a TiledMap of tiled smoothed with a size x size Gaussian kernel, rounded to
+	tiled's dtype. Tiles are blurred separately with a halo of size // 2 pixels, in the
+	threads of pool if it is set.
+	'''
+	limit = np.iinfo(tiled.dtype).max
+	return tiled.map_tiles(lambda window: np.minimum(np.rint(gaussian_blur(window, size)), limit), size // 2, pool=pool)
+
+def blur_maps(maps, size, processes=None):
+	'''
+	Returns blur_map of each of maps, blurring the tiles of each map in a pool of
+	processes threads (None uses every CPU). NumPy releases the GIL while convolving,
+	so the threads run in parallel without copying the maps to other processes.
+	'''
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	if processes <= 1:
+		return [blur_map(tiled, size) for tiled in maps]
+	pool = ThreadPool(processes)
+	try:
+		return [blur_map(tiled, size, pool) for tiled in maps]
+	finally:
+		pool.close()
+		pool.join()
+
+def threshold_map(tiled, threshold):
+	'''
+	Returns a uint8 TiledMap that is 255 where tiled is above threshold and 0 elsewhere.
+	'''
+	return tiled.map_tiles(lambda window: np.where(window > threshold, 255, 0), 0, np.uint8)
+
+def line_pixels(origs, dests):
+	'''
+	Returns the 8-connected pixels of the lines from pixels origs to pixels dests, (N, 2)
+	arrays of (col, row), as arrays (lines, cols, rows).
+
+	Each line is sampled once per step along its major axis, so it has
+	max(|dx|, |dy|) + 1 pixels, and lines[i] tells which line pixel i belongs to. The
+	pixels of the reversed line are the same.
+	'''
+	origs = np.asarray(origs, dtype=np.int64).reshape(-1, 2)
+	dests = np.asarray(dests, dtype=np.int64).reshape(-1, 2)
+	deltas = dests - origs
+	steps = np.abs(deltas).max(axis=1)
+	lines = np.repeat(np.arange(len(origs)), steps + 1)
+	# the step of each pixel within its line
+	positions = np.arange(len(lines)) - np.repeat(np.cumsum(steps + 1) - (steps + 1), steps + 1)
+	fractions = positions / np.maximum(steps, 1).astype(np.float64)[lines]
+	cols = np.rint(origs[lines, 0] + fractions * deltas[lines, 0]).astype(np.int64)
+	rows = np.rint(origs[lines, 1] + fractions * deltas[lines, 1]).astype(np.int64)
+	return lines, cols, rows
+
+def sector_support(sector_maps, origs, dests):
+	'''
+	Returns (forward, reverse): for each line from origs to dests (see line_pixels), the
+	sum along it of the eight sector_maps, TiledMaps, for its heading sector and the two
+	neighbouring sectors, and the same for the reversed line.
+
+	Every sector map is read once for the pixels of all the lines, and the sums are taken
+	per line with one reduceat.
+	'''
+	origs = np.asarray(origs, dtype=np.int64).reshape(-1, 2)
+	dests = np.asarray(dests, dtype=np.int64).reshape(-1, 2)
+	if not len(origs):
+		return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+	lines, cols, rows = line_pixels(origs, dests)
+	values = np.vstack([sector_map.values_at(rows, cols) for sector_map in sector_maps])
+	starts = np.flatnonzero(np.diff(lines)) + 1
+	sums = np.add.reduceat(values, np.concatenate([[0], starts]), axis=1, dtype=np.int64)
+	sectors = get_sectors(origs[:, 0], origs[:, 1], dests[:, 0], dests[:, 1])
+	line_ids = np.arange(len(origs))
+	def support(sectors):
+		return sums[sectors, line_ids] + sums[(sectors + 1) % 8, line_ids] + sums[(sectors + 7) % 8, line_ids]
+	return support(sectors), support(get_sectors(dests[:, 0], dests[:, 1], origs[:, 0], origs[:, 1]))
+
+def map_cache_path(cache_dir, trips_path, trip_max, cell_size, pattern='*'):
+	'''
+	Returns the directory in cache_dir holding the intensity maps for the first trip_max
+	trips in trips_path rasterized at cell_size.
+
+	The name is kde_<source>_<digest>. source identifies trips_path, pattern, trip_max
+	and cell_size, so that caches made stale by the trips changing can be found and
+	removed (see _remove_stale_caches). digest covers the names, sizes and modification
+	times of the trip files together with trip_max, cell_size and MAP_CACHE_VERSION, so
+	any change to the inputs selects a different directory.
+	'''
+	files = list_trace_files(trips_path, pattern, trip_max)
+	source = hashlib.sha1('{} {} {!r} {!r}'.format(os.path.abspath(trips_path), pattern, trip_max, cell_size)).hexdigest()[:16]
+	digest = hashlib.sha1('{} {} {!r} {}'.format(MAP_CACHE_VERSION, trace_files_key(files), cell_size, trip_max))
+	return os.path.join(cache_dir, 'kde_{}_{}'.format(source, digest.hexdigest()))
+
+def _temporary_path(path):
+	tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+	if os.path.isdir(tmp_path):
+		shutil.rmtree(tmp_path)
+	return tmp_path
+
+def _remove_stale_caches(path):
+	'''
+	Deletes the other caches next to path from the same source (see map_cache_path),
+	leaving the temporary directories of builds in progress alone.
+	'''
+	cache_dir, name = os.path.split(path)
+	if not name.startswith('kde_') or name.count('_') != 2:
+		# not named by map_cache_path, so there is no source to match
+		return
+	prefix = name[:name.rindex('_') + 1]
+	for other in os.listdir(cache_dir or '.'):
+		if other.startswith(prefix) and other != name and not other.endswith('.tmp'):
+			shutil.rmtree(os.path.join(cache_dir, other))
+
+def write_map_cache(path, themap, sector_maps):
+	'''
+	Saves themap and the eight sector_maps, dense arrays or TiledMaps, into the directory
+	path as TiledMaps.
+
+	The maps are written to a temporary directory that is renamed into place, so a
+	partially written cache is never picked up. Stale caches of the same source are then
+	deleted.
+	'''
+	tmp_path = _temporary_path(path)
+	for name, values in [('map', themap)] + [('sector{}'.format(sector), sector_maps[sector]) for sector in range(8)]:
+		if not isinstance(values, TiledMap):
+			values = TiledMap.from_array(values)
+		values.save(os.path.join(tmp_path, name))
+	os.rename(tmp_path, path)
+	_remove_stale_caches(path)
+
+def build_map_cache(path, trips, grid, tile_size=TILE_SIZE):
+	'''
+	Rasterizes trips straight into memory-mapped tiles in the directory path, so maps
+	larger than memory can be built, and returns them as open_map_cache does. Stale
+	caches of the same source are deleted, as in write_map_cache.
+	'''
+	tmp_path = _temporary_path(path)
+	themap, sector_maps = rasterize_trips(trips, grid, tile_size=tile_size, directory=tmp_path)
+	for tiled in [themap] + sector_maps:
+		tiled.flush()
+	del themap, sector_maps
+	os.rename(tmp_path, path)
+	_remove_stale_caches(path)
+	return open_map_cache(path)
+
+def open_map_cache(path):
+	'''
+	Opens maps saved by write_map_cache or build_map_cache, returning (themap,
+	sector_maps) as TiledMaps, or None if path holds no complete cache.
+
+	Tiles are memory-mapped copy-on-write when first used, so pixels are read from disk
+	only as they are needed and the cache itself never changes.
+	'''
+	directories = [os.path.join(path, 'map')] + [os.path.join(path, 'sector{}'.format(sector)) for sector in range(8)]
+	if not all(os.path.isfile(os.path.join(directory, 'map.json')) for directory in directories):
+		return None
+	maps = [TiledMap.load(directory) for directory in directories]
+	return maps[0], maps[1:]
@@ -1,30 +1,54 @@
-from util import Trace, Observation, Point, PointWithID, Index, Graph, vector_angle, read_traces
+from util import Trace, TraceStore, Observation, Point, PointWithID, Index, BearingIndex, Graph, vector_angle, bearing_difference, read_traces, read_graph
+import numpy as np
+import ctypes
 import math
+import multiprocessing
+import os
 import random
+from multiprocessing.sharedctypes import RawArray
 
 SEED_DISTANCE = 20
 DISTANCE_THRESHOLD = 70
 BEARING_THRESHOLD = 45
 MOVEMENT_THRESHOLD = 10
+MIN_SUPPORT = 1
+CHECKPOINT_FILE = 'kmeans-checkpoint.npz'
+CHECKPOINT_INTERVAL = 5
 
 class Cluster(Point):
-	def __init__(self, center):
+	def __init__(self, center, clustering=None, index=None):
 		'''
 		Initialize a cluster.
 
-		center is an instance of Point (see util.py).
+		center is an instance of Point (see util.py). A cluster created by a Clustering is
+		a view of cluster index in it, and its members come from the clustering's
+		assignment array; other clusters keep their members in a list.
 		'''
 		super(Cluster, self).__init__(center.x, center.y, center.bearing)
 		self.center = center
-		self.members = []
+		self.clustering = clustering
+		self.index = index
+		self._members = [] if clustering is None else None
+
+	@property
+	def members(self):
+		'''
+		The list of points in this cluster.
+		'''
+		if self._members is None:
+			return self.clustering.members_of(self.index)
+		return self._members
 
 	def add_member(self, point):
 		'''
 		Add a new member to this cluster.
 
-		point is an instance of Point (see util.py).
+		point is an instance of Point (see util.py). A view copies its members into a list
+		first, and no longer follows its clustering.
 		'''
-		self.members.append(point)
+		if self._members is None:
+			self._members = self.members
+		self._members.append(point)
 
 	def get_mean(self):
 		'''
@@ -34,26 +58,99 @@ class Cluster(Point):
 		is computed by averaging the x and y components of the unit vectors represented by
 		the bearing.
 		'''
-		if not self.members:
+		members = self.members
+		if not members:
 			return self.center
 
 		x = 0
 		y = 0
 		bearing_x = 0
 		bearing_y = 0
-		for member in self.members:
+		for member in members:
 			x += member.x
 			y += member.y
 			bearing_x += math.cos(math.radians(member.bearing))
 			bearing_y += math.sin(math.radians(member.bearing))
-		x /= len(self.members)
-		y /= len(self.members)
-		bearing_x /= len(self.members)
-		bearing_y /= len(self.members)
+		x /= len(members)
+		y /= len(members)
+		bearing_x /= len(members)
+		bearing_y /= len(members)
 		return Point(x, y, math.degrees(vector_angle(bearing_x, bearing_y)))
 
 	def __repr__(self):
-		return 'Cluster at {} ({} members)'.format(self.center, len(self.members))
+		if self._members is None:
+			size = self.clustering.counts[self.index]
+		else:
+			size = len(self._members)
+		return 'Cluster at {} ({} members)'.format(self.center, size)
+
+class Clustering(object):
+	def __init__(self, markers, positions, bearings, assignments):
+		'''
+		The result of clustering a list of markers, held in arrays.
+
+		positions (n, 2) and bearings give the center of every cluster, and assignments
+		gives the cluster of every marker in markers, or -1 for none. counts holds the
+		number of members of every cluster.
+
+		A clustering is a sequence of Cluster views, one per cluster. The views are created
+		once, so fields such as vertex that are set on them stay.
+		'''
+		self.markers = markers
+		self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+		self.bearings = np.asarray(bearings, dtype=np.float64)
+		self.assignments = np.asarray(assignments, dtype=np.int64)
+		self.counts = np.bincount(self.assignments[self.assignments >= 0], minlength=len(self.bearings))
+		self.clusters = [Cluster(Point(x, y, bearing), self, i) for i, ((x, y), bearing) in enumerate(zip(self.positions.tolist(), self.bearings.tolist()))]
+		self._member_order = None
+		self._member_offsets = None
+		self._lookup = None
+
+	def __len__(self):
+		return len(self.clusters)
+
+	def __getitem__(self, i):
+		return self.clusters[i]
+
+	def __iter__(self):
+		return iter(self.clusters)
+
+	def __repr__(self):
+		return repr(self.clusters)
+
+	def members_of(self, cluster):
+		'''
+		Returns the markers assigned to a cluster, in marker order.
+		'''
+		if self._member_order is None:
+			# a stable sort groups the markers of each cluster, with unassigned ones first
+			self._member_order = np.argsort(self.assignments, kind='mergesort')
+			self._member_offsets = np.searchsorted(self.assignments[self._member_order], np.arange(len(self) + 1))
+		start, end = self._member_offsets[cluster], self._member_offsets[cluster + 1]
+		return [self.markers[i] for i in self._member_order[start:end].tolist()]
+
+	def cluster_of(self, marker_ids):
+		'''
+		Returns the cluster of the markers with the given IDs as an array, with -1 for
+		markers that have no cluster or are not in this clustering.
+
+		When marker IDs are the positions of the markers, as from get_markers, the
+		assignment array itself is the lookup table.
+		'''
+		if self._lookup is None:
+			ids = np.array([marker.id for marker in self.markers], dtype=np.int64)
+			if np.array_equal(ids, np.arange(len(ids))):
+				self._lookup = self.assignments
+			else:
+				self._lookup = np.empty(ids.max() + 1 if len(ids) else 0, dtype=np.int64)
+				self._lookup.fill(-1)
+				self._lookup[ids] = self.assignments
+		marker_ids = np.asarray(marker_ids, dtype=np.int64)
+		clusters = np.empty(len(marker_ids), dtype=np.int64)
+		clusters.fill(-1)
+		known = (marker_ids >= 0) & (marker_ids < len(self._lookup))
+		clusters[known] = self._lookup[marker_ids[known]]
+		return clusters
 
 def get_markers(traces, seed_distance):
 	'''
@@ -71,41 +168,70 @@ def get_markers(traces, seed_distance):
 	(10, 50, 0), and (40, 50, 0).
 	'''
 
-	def get_trace_markers(trace):
-		'''
-		Create and return list of seed points for this trace.
-		'''
-		last_distance = seed_distance
-		seed_points = []
-		for i in xrange(len(trace.observations) - 1):
-			next_obs = trace.observations[i + 1]
-			point = trace.observations[i].to_point(next_obs)
-			while point.distance_to(next_obs) > seed_distance - last_distance:
-				length = point.distance_to(next_obs)
-				factor = (seed_distance - last_distance) / length
-				point.x, point.y = (point.x + (next_obs.x - point.x) * factor), (point.y + (next_obs.y - point.y) * factor)
-				seed_points.append(Point(point.x, point.y, point.bearing))
-				last_distance = 0
-			last_distance += point.distance_to(trace.observations[i + 1])
-		return seed_points
+	return markers_from_arrays(*get_marker_arrays(traces, seed_distance))
 
-	# return a list of markers corresponding to each trace
+def markers_from_arrays(xs, ys, bearings, trace_offsets):
+	'''
+	Returns the list of markers of every trace for marker arrays as returned by
+	get_marker_arrays.
+	'''
 	# we assign global IDs to each marker to use later
-	markers_by_trace = []
-	next_id = 0
-	for trace in traces:
-		trace_markers = []
-		for marker in get_trace_markers(trace):
-			trace_markers.append(PointWithID(next_id, marker.x, marker.y, marker.bearing))
-			next_id += 1
-		markers_by_trace.append(trace_markers)
-	return markers_by_trace
-
-def initialize_clusters(markers, distance_threshold, bearing_threshold):
+	markers = [PointWithID(id, x, y, bearing) for id, (x, y, bearing) in enumerate(zip(xs.tolist(), ys.tolist(), bearings.tolist()))]
+
+	# return a list of markers corresponding to each trace
+	return [markers[start:end] for start, end in zip(trace_offsets[:-1].tolist(), trace_offsets[1:].tolist())]
+
+def get_marker_arrays(traces, seed_distance):
+	'''
+	Vectorized form of get_markers, returning arrays instead of PointWithID objects.
+
+	traces is a TraceStore or a list of Trace objects. Returns (xs, ys, bearings,
+	trace_offsets): the marker with ID i is at (xs[i], ys[i]) with bearing bearings[i],
+	and the markers of trace t have IDs trace_offsets[t] to trace_offsets[t + 1] - 1.
+
+	A trace of total length T gets markers at arc lengths 0, seed_distance,
+	2 * seed_distance, ... strictly below T. Each marker lies on the first segment
+	[c, c + length) containing its arc length and takes that segment's bearing, so
+	zero-length segments never receive markers.
+	'''
+	if not isinstance(traces, TraceStore):
+		traces = TraceStore.from_traces(traces)
+	obs_xs, obs_ys, _ = traces.columns()
+	starts = traces.offsets[:-1] - traces.offsets[0]
+	ends = traces.offsets[1:] - traces.offsets[0]
+
+	# segment j joins observations j and j + 1; segments joining two traces get length zero
+	dxs = np.diff(obs_xs)
+	dys = np.diff(obs_ys)
+	lengths = np.hypot(dxs, dys)
+	joins = ends[(ends > 0) & (ends < len(obs_xs))] - 1
+	lengths[joins] = 0
+	cumulative = np.concatenate([[0.0], np.cumsum(lengths)])
+
+	nonempty = ends > starts
+	totals = np.zeros(len(traces))
+	totals[nonempty] = cumulative[ends[nonempty] - 1] - cumulative[starts[nonempty]]
+	counts = np.where(totals > 0, np.ceil(totals / seed_distance), 0).astype(np.int64)
+	trace_offsets = np.zeros(len(traces) + 1, dtype=np.int64)
+	trace_offsets[1:] = np.cumsum(counts)
+
+	marker_traces = np.repeat(np.arange(len(traces)), counts)
+	steps = np.arange(trace_offsets[-1]) - trace_offsets[:-1][marker_traces]
+	arc_lengths = cumulative[starts[marker_traces]] + steps * float(seed_distance)
+	segments = np.searchsorted(cumulative, arc_lengths, side='right') - 1
+	segments = np.clip(segments, starts[marker_traces], ends[marker_traces] - 2)
+
+	factors = (arc_lengths - cumulative[segments]) / lengths[segments]
+	xs = obs_xs[segments] + dxs[segments] * factors
+	ys = obs_ys[segments] + dys[segments] * factors
+	bearings = np.degrees(np.arctan2(dys[segments], dxs[segments]))
+	return xs, ys, bearings, trace_offsets
+
+def initialize_clusters(markers, distance_threshold, bearing_threshold, seed=None):
 	'''
 	Create an initial set of clusters.
 
-	Return a list of Cluster objects.
+	Return a Clustering, which is a sequence of Cluster objects.
 
 	markers is a list of PointWithID instances.
 
@@ -121,30 +247,292 @@ def initialize_clusters(markers, distance_threshold, bearing_threshold):
 	
 	You might find Index (from util.py) useful to query points that are near a specified
 	location.
+
+	Markers are picked in an order drawn from random.Random(seed), so passing the same
+	seed reproduces the same clusters.
 	'''
-        clusters = []
-	markers = markers[:]
-        index = Index(markers)
-        while markers:
-            random_marker = markers[random.randint(0, len(markers) - 1)]
-            markers.remove(random_marker)
-            
-            nearest_markers = index.nearby(random_marker, distance_threshold)
+	index = BearingIndex(markers, cell_size=distance_threshold)
+	positions = dict((id(marker), i) for i, marker in enumerate(markers))
+	assignments = np.empty(len(markers), dtype=np.int64)
+	assignments.fill(-1)
+	centers = []
+
+	# visiting markers in a random order and skipping assigned ones is the same as picking
+	# a random unassigned marker each round, but touches every marker only once
+	order = range(len(markers))
+	random.Random(seed).shuffle(order)
+	for i in order:
+		if assignments[i] >= 0:
+			continue
+		random_marker = markers[i]
+		assignments[i] = len(centers)
+		index.remove(random_marker)
 
-            nearest_markers = [marker for marker in  nearest_markers if marker.angle_to(random_marker) <= bearing_threshold]
+		# the index only holds unassigned markers
+		nearest_markers = index.nearby(random_marker, distance_threshold, bearing_threshold)
+		for marker in nearest_markers:
+			assignments[positions[id(marker)]] = len(centers)
+			index.remove(marker)
 
-            cluster = Cluster(random_marker)
-            cluster.add_member(random_marker)
-            for marker in nearest_markers:
-                cluster.add_member(marker)
+		centers.append(random_marker)
 
-            clusters.append(cluster)
+	center_positions = np.array([[center.x, center.y] for center in centers], dtype=np.float64)
+	center_bearings = np.array([center.bearing for center in centers], dtype=np.float64)
+	return Clustering(markers, center_positions, center_bearings, assignments)
 
-            markers = list(set(markers) - set(nearest_markers))
-        return clusters
+def similarity_metrics(distances, marker_bearings, cluster_bearings):
+	'''
+	Returns similarity metrics between markers and clusters, given their distances and
+	bearings as arrays.
 	
+	A lower value indicates greater similarity.
+	'''
+	return distances + bearing_difference(marker_bearings, cluster_bearings)
+
+def cluster_means(assignments, marker_positions, marker_bearings, positions, bearings):
+	'''
+	Returns (positions, bearings) arrays holding the mean of every cluster's members.
+
+	assignments gives the cluster of each marker, or -1 for none. As in Cluster.get_mean,
+	bearings are averaged over the x and y components of their unit vectors, and a
+	cluster without members stays at its current position and bearing.
+	'''
+	count = len(positions)
+	assigned = assignments >= 0
+	owners = assignments[assigned]
+	radians = np.radians(marker_bearings[assigned])
+	sizes = np.bincount(owners, minlength=count)
+	sum_x = np.bincount(owners, weights=marker_positions[assigned, 0], minlength=count)
+	sum_y = np.bincount(owners, weights=marker_positions[assigned, 1], minlength=count)
+	sum_bearing_x = np.bincount(owners, weights=np.cos(radians), minlength=count)
+	sum_bearing_y = np.bincount(owners, weights=np.sin(radians), minlength=count)
+
+	new_positions = positions.copy()
+	new_bearings = bearings.copy()
+	occupied = sizes > 0
+	new_positions[occupied, 0] = sum_x[occupied] / sizes[occupied]
+	new_positions[occupied, 1] = sum_y[occupied] / sizes[occupied]
+	new_bearings[occupied] = np.degrees(np.arctan2(sum_bearing_y[occupied], sum_bearing_x[occupied]))
+	return new_positions, new_bearings
+
+def assign_markers(cluster_index, bearings, marker_positions, marker_bearings, distance_threshold, fallback=True):
+	'''
+	Returns an array giving the most similar cluster for every marker.
+
+	cluster_index indexes the cluster positions, with bearings the matching array of
+	cluster bearings. Candidate clusters for every marker are found with one batched index
+	query. A marker with no cluster within distance_threshold goes to the nearest cluster
+	instead, or to -1 if the index is empty or fallback is False.
+	'''
+	offsets, candidates, distances = cluster_index.nearby_many(marker_positions, distance_threshold)
+	owners = np.repeat(np.arange(len(marker_positions)), np.diff(offsets))
+	metrics = similarity_metrics(distances, marker_bearings[owners], bearings[candidates])
+
+	# sorting by marker and then metric puts each marker's best cluster first in its run
+	order = np.lexsort((metrics, owners))
+	has_candidates = offsets[1:] > offsets[:-1]
+	assignments = np.empty(len(marker_positions), dtype=np.int64)
+	assignments.fill(-1)
+	assignments[has_candidates] = candidates[order[offsets[:-1][has_candidates]]]
+	if fallback:
+		assign_nearest(cluster_index, assignments, marker_positions, marker_bearings)
+	return assignments
+
+def assign_nearest(cluster_index, assignments, marker_positions, marker_bearings):
+	'''
+	Assigns every marker that has cluster -1 in assignments to its nearest cluster.
+	'''
+	for marker in np.flatnonzero(assignments < 0).tolist():
+		x, y = marker_positions[marker]
+		nearest, _ = cluster_index.nearest_indices(Point(x, y, marker_bearings[marker]))
+		assignments[marker] = nearest[0] if len(nearest) else -1
+
+def marker_tiles(marker_positions, tile_size):
+	'''
+	Partitions markers into square tiles of side tile_size.
+
+	Returns (order, spans): the markers of each tile are order[start:end] for one
+	(start, end) pair in spans.
+	'''
+	if not len(marker_positions):
+		return np.zeros(0, dtype=np.int64), []
+	cells = np.floor((marker_positions - marker_positions.min(axis=0)) / tile_size).astype(np.int64)
+	keys = cells[:, 0] * (cells[:, 1].max() + 1) + cells[:, 1]
+	order = np.argsort(keys, kind='mergesort')
+	_, starts = np.unique(keys[order], return_index=True)
+	ends = np.append(starts[1:], len(order))
+	return order, zip(starts.tolist(), ends.tolist())
+
+def _share(array):
+	'''
+	Returns a copy of array in shared memory, which forked worker processes inherit.
+	'''
+	raw = RawArray(ctypes.c_char, max(1, array.nbytes))
+	shared = np.frombuffer(raw, dtype=array.dtype, count=array.size).reshape(array.shape)
+	shared[...] = array
+	return shared
+
+# arrays shared by kmeans_arrays with its assignment workers
+_worker_state = {}
+
+def _init_assign_worker(state):
+	_worker_state.update(state)
 
-def kmeans(markers, initial_clusters, distance_threshold, movement_threshold):
+def _assign_tile(span):
+	'''
+	Assigns the markers of one tile against the clusters within distance_threshold of it.
+
+	Markers with no cluster in range are left at -1 for the caller to resolve, since their
+	nearest cluster may lie outside the tile's halo.
+	'''
+	state = _worker_state
+	distance_threshold = state['distance_threshold']
+	markers = state['order'][span[0]:span[1]]
+	marker_positions = state['marker_positions'][markers]
+	low = marker_positions.min(axis=0) - distance_threshold
+	high = marker_positions.max(axis=0) + distance_threshold
+	positions = state['positions']
+	local = np.flatnonzero(((positions >= low) & (positions <= high)).all(axis=1))
+	if not len(local):
+		state['assignments'][markers] = -1
+		return
+	index = Index(positions[local], backend='grid', cell_size=distance_threshold)
+	assignments = assign_markers(index, state['bearings'][local], marker_positions, state['marker_bearings'][markers], distance_threshold, fallback=False)
+	found = assignments >= 0
+	assignments[found] = local[assignments[found]]
+	state['assignments'][markers] = assignments
+
+def reconsidered_markers(marker_index, marker_positions, assignments, changed, old_positions, positions, distance_threshold):
+	'''
+	Returns the sorted positions of markers whose best cluster may have changed.
+
+	changed is a mask of the clusters that moved since the last assignment. Only markers
+	within distance_threshold of the old or new position of a changed cluster can gain or
+	lose it as a candidate, and markers assigned to a changed cluster must compare it
+	again. Markers with no cluster in range went to the nearest cluster, which any move
+	can change, so they are always included.
+	'''
+	moved = np.flatnonzero(changed)
+	_, near, _ = marker_index.nearby_many(np.vstack([old_positions[moved], positions[moved]]), distance_threshold)
+	assigned = np.clip(assignments, 0, None)
+	stranded = (assignments < 0) | (np.hypot(*(marker_positions - positions[assigned]).T) > distance_threshold)
+	mask = stranded | changed[assigned]
+	mask[near] = True
+	return np.flatnonzero(mask)
+
+def kmeans_arrays(marker_positions, marker_bearings, positions, bearings, assignments, distance_threshold, movement_threshold, processes=1, tolerance=None, stats=None, checkpoint=None, iteration=0):
+	'''
+	Array form of kmeans below.
+
+	marker_positions is an (n, 2) array of marker coordinates and marker_bearings their
+	bearings; positions and bearings hold the initial clusters in the same way, and
+	assignments gives the initial cluster of each marker (-1 for none). If no marker has a
+	cluster, the first iteration only assigns them, and does not count toward
+	convergence.
+
+	If processes is more than one (None uses every CPU), markers are split into spatial
+	tiles that are assigned by a pool of worker processes. Workers read the marker and
+	cluster arrays from shared memory, and each only searches the clusters within
+	distance_threshold of its tile.
+
+	If tolerance is given, iterations after the first are incremental: a cluster counts
+	as changed when its distance moved plus its bearing change exceeds tolerance, and only
+	the markers returned by reconsidered_markers are assigned again (with processes, every
+	tile holding such a marker). A tolerance of 0 gives the same clusters as a full pass.
+
+	If stats is a list, a dict with the moved distance, the number of changed clusters
+	and the number of reconsidered markers is appended to it for every iteration.
+
+	If checkpoint is given, it is called as checkpoint(iteration, distance, positions,
+	bearings, assignments) after every iteration, for example to save the run with
+	write_checkpoint. iteration counts the iterations already run, so that a run resumed
+	from a checkpoint keeps numbering where it stopped.
+
+	Returns the final (positions, bearings, assignments) arrays.
+	'''
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	pool = None
+	if processes > 1 and len(marker_positions):
+		# a few tiles per process balance the load, while tiles much smaller than the
+		# search radius would mostly search each other's halos
+		extent = marker_positions.max(axis=0) - marker_positions.min(axis=0)
+		tile_size = max(2 * distance_threshold, math.sqrt(extent[0] * extent[1] / (4 * processes)))
+		order, spans = marker_tiles(marker_positions, tile_size)
+		tile_of = np.empty(len(order), dtype=np.int64)
+		tile_of[order] = np.repeat(np.arange(len(spans)), [end - start for start, end in spans])
+		shared = {
+			'distance_threshold': distance_threshold,
+			'order': _share(order),
+			'marker_positions': _share(marker_positions),
+			'marker_bearings': _share(marker_bearings),
+			'positions': _share(positions),
+			'bearings': _share(bearings),
+			'assignments': _share(assignments),
+		}
+		pool = multiprocessing.Pool(processes, _init_assign_worker, (shared,))
+	marker_index = None
+	if tolerance is not None:
+		marker_index = Index(marker_positions, backend='grid', cell_size=distance_threshold)
+
+	try:
+		# one index over cluster positions is kept for the whole run, and only clusters
+		# that moved are updated
+		index = None
+		distance = float('inf')
+		while distance >= movement_threshold:
+			had_members = (assignments >= 0).any()
+			new_positions, new_bearings = cluster_means(assignments, marker_positions, marker_bearings, positions, bearings)
+			offsets = np.hypot(*(new_positions - positions).T)
+			distance = offsets.sum()
+			changed = offsets + bearing_difference(bearings, new_bearings) > (tolerance or 0)
+			reconsider = None
+			if index is None:
+				index = Index(new_positions.copy(), backend='grid', cell_size=distance_threshold)
+			else:
+				for slot in np.flatnonzero((new_positions != positions).any(axis=1)).tolist():
+					index.move_index(slot, new_positions[slot])
+				if marker_index is not None:
+					reconsider = reconsidered_markers(marker_index, marker_positions, assignments, changed, positions, new_positions, distance_threshold)
+			positions, bearings = new_positions, new_bearings
+
+			if pool is None and reconsider is None:
+				assignments = assign_markers(index, bearings, marker_positions, marker_bearings, distance_threshold)
+				reconsidered = len(assignments)
+			elif pool is None:
+				assignments = assignments.copy()
+				assignments[reconsider] = assign_markers(index, bearings, marker_positions[reconsider], marker_bearings[reconsider], distance_threshold)
+				reconsidered = len(reconsider)
+			else:
+				tiles = np.arange(len(spans)) if reconsider is None else np.unique(tile_of[reconsider])
+				shared['positions'][...] = positions
+				shared['bearings'][...] = bearings
+				pool.map(_assign_tile, [spans[tile] for tile in tiles.tolist()], 1)
+				assignments = shared['assignments'].copy()
+				# workers leave markers with no cluster in range at -1, including those
+				# of tiles skipped in this iteration, and all of them are resolved here
+				reconsidered = np.count_nonzero(np.in1d(tile_of, tiles) | (assignments < 0))
+				assign_nearest(index, assignments, marker_positions, marker_bearings)
+
+			if stats is not None:
+				stats.append({'distance': distance, 'changed': np.count_nonzero(changed), 'reconsidered': reconsidered})
+			print 'moved clusters distance={} reconsidered={}'.format(distance, reconsidered)
+			if not had_members and (assignments >= 0).any():
+				# clusters that started without members, as in a warm start, could not move
+				# before this first assignment, so it says nothing about convergence
+				distance = float('inf')
+			iteration += 1
+			if checkpoint is not None:
+				checkpoint(iteration, distance, positions, bearings, assignments)
+		if pool is not None:
+			pool.close()
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+	return positions, bearings, assignments
+
+def kmeans(markers, initial_clusters, distance_threshold, movement_threshold, processes=1, tolerance=None, stats=None):
 	'''
 	Run K-means algorithm on the clusters.
 
@@ -165,85 +553,448 @@ def kmeans(markers, initial_clusters, distance_threshold, movement_threshold):
 	the first cluster while the other two are assigned to the second cluster. On the next
 	recomputation step, the first cluster moves 0 units, and the second cluster moves 0.1
 	units; if movement_threshold > 0.1, then we would terminate.
+
+	The iterations run on arrays in kmeans_arrays; this wraps markers and clusters into
+	arrays and returns the result as a Clustering of markers. processes, tolerance and
+	stats are passed to kmeans_arrays.
 	'''
-	def similarity_metric(cluster, marker):
+	marker_positions, marker_bearings = marker_arrays(markers)
+	positions, bearings, assignments = cluster_arrays(markers, initial_clusters)
+	positions, bearings, assignments = kmeans_arrays(marker_positions, marker_bearings, positions, bearings, assignments, distance_threshold, movement_threshold, processes, tolerance, stats)
+	return Clustering(markers, positions, bearings, assignments)
+
+def marker_arrays(markers):
+	'''
+	Returns (marker_positions, marker_bearings) arrays for a list of markers.
+	'''
+	marker_positions = np.array([[marker.x, marker.y] for marker in markers], dtype=np.float64).reshape(-1, 2)
+	marker_bearings = np.array([marker.bearing for marker in markers], dtype=np.float64)
+	return marker_positions, marker_bearings
+
+def cluster_arrays(markers, clusters):
+	'''
+	Returns (positions, bearings, assignments) arrays for a list of clusters, where
+	assignments gives the cluster each of markers is a member of, or -1 for none.
+
+	A Clustering of the same markers already holds these arrays, and they are returned
+	as they are.
+	'''
+	if isinstance(clusters, Clustering) and clusters.markers is markers:
+		return clusters.positions, clusters.bearings, clusters.assignments
+	positions = np.array([[cluster.x, cluster.y] for cluster in clusters], dtype=np.float64).reshape(-1, 2)
+	bearings = np.array([cluster.bearing for cluster in clusters], dtype=np.float64)
+	marker_slots = dict((id(marker), i) for i, marker in enumerate(markers))
+	assignments = np.empty(len(markers), dtype=np.int64)
+	assignments.fill(-1)
+	for i, cluster in enumerate(clusters):
+		for member in cluster.members:
+			if id(member) in marker_slots:
+				assignments[marker_slots[id(member)]] = i
+	return positions, bearings, assignments
+
+def _longest_edges(ends, lengths, count):
+	'''
+	Returns, for each of count vertices, the ID of its longest edge among those whose
+	endpoint in ends is the vertex, or -1 if it has no edge of non-zero length.
+	'''
+	longest = np.full(count, -1, dtype=np.int64)
+	edge_ids = np.flatnonzero(lengths > 0)
+	# sorted by vertex then length, so the last edge of each vertex is its longest
+	edge_ids = edge_ids[np.lexsort((lengths[edge_ids], ends[edge_ids]))]
+	longest[ends[edge_ids]] = edge_ids
+	return longest
+
+def write_cluster_bearings(fname, bearings):
+	'''
+	Writes the bearing of each cluster to fname, a sidecar to the .graph file whose
+	vertices are the clusters: one bearing in degrees per line, in vertex order.
+	'''
+	with open(fname, 'w') as f:
+		f.writelines(['{!r}\n'.format(bearing) for bearing in np.asarray(bearings, dtype=np.float64).tolist()])
+
+def read_cluster_bearings(fname):
+	'''
+	Returns the bearings written by write_cluster_bearings as an array, or None if fname
+	does not exist.
+	'''
+	if not os.path.isfile(fname):
+		return None
+	with open(fname, 'r') as f:
+		return np.fromstring(f.read(), dtype=np.float64, sep=' ')
+
+def graph_cluster_arrays(graph, bearings=None):
+	'''
+	Returns (positions, bearings) arrays with one cluster at every vertex of graph, for
+	example a graph inferred by an earlier run, to warm-start kmeans_arrays.
+
+	If bearings is given, such as the cluster bearings saved with the graph by
+	write_cluster_bearings, it is used as is. Bearings from the edges are only a rough
+	guess at the clusters' ones, so warm starts take many more iterations without it.
+
+	Otherwise a vertex's bearing averages the unit vectors of its incoming and outgoing edges in
+	their direction of travel. On two-way streets those cancel out, so where their sum
+	is shorter than half a unit vector the bearing follows the vertex's longest outgoing
+	edge, or failing that its longest incoming one; a vertex without edges of non-zero
+	length gets bearing 0.
+	'''
+	xs, ys, srcs, dsts = graph.arrays()
+	positions = np.column_stack([xs, ys]).reshape(-1, 2)
+	if bearings is not None:
+		bearings = np.asarray(bearings, dtype=np.float64)
+		if len(bearings) != len(xs):
+			raise ValueError('got {} cluster bearings for a graph with {} vertices'.format(len(bearings), len(xs)))
+		return positions, bearings
+	dxs = xs[dsts] - xs[srcs]
+	dys = ys[dsts] - ys[srcs]
+	lengths = np.hypot(dxs, dys)
+	unit_lengths = np.where(lengths == 0, np.inf, lengths)
+	sum_x = np.zeros(len(xs))
+	sum_y = np.zeros(len(xs))
+	for ends in (srcs, dsts):
+		sum_x += np.bincount(ends, weights=dxs / unit_lengths, minlength=len(xs))
+		sum_y += np.bincount(ends, weights=dys / unit_lengths, minlength=len(xs))
+	dominant = _longest_edges(srcs, lengths, len(xs))
+	incoming = _longest_edges(dsts, lengths, len(xs))
+	dominant[dominant < 0] = incoming[dominant < 0]
+	cancelled = (np.hypot(sum_x, sum_y) < 0.5) & (dominant >= 0)
+	sum_x[cancelled] = dxs[dominant[cancelled]]
+	sum_y[cancelled] = dys[dominant[cancelled]]
+	return positions, np.degrees(np.arctan2(sum_y, sum_x))
+
+def clusters_from_graph(graph, bearings=None):
+	'''
+	Returns a Clustering with a cluster without members at every vertex of graph, which
+	kmeans accepts as initial_clusters in place of the result of initialize_clusters.
+	bearings is as in graph_cluster_arrays.
+	'''
+	positions, bearings = graph_cluster_arrays(graph, bearings)
+	return Clustering([], positions, bearings, np.zeros(0, dtype=np.int64))
+
+def write_checkpoint(fname, marker_positions, marker_bearings, trace_offsets, positions, bearings, assignments, iteration, distance):
+	'''
+	Saves the state of a k-means run to fname.
+
+	The markers (with trace_offsets as returned by get_marker_arrays), clusters and
+	assignments are stored as arrays in one uncompressed npz file, together with the
+	number of iterations run and the distance moved in the last one. The file is
+	written to a temporary file and renamed into place, so a crash while writing leaves
+	the previous checkpoint intact.
+	'''
+	tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+	with open(tmp_fname, 'wb') as f:
+		np.savez(
+			f,
+			marker_positions=marker_positions,
+			marker_bearings=marker_bearings,
+			trace_offsets=trace_offsets,
+			positions=positions,
+			bearings=bearings,
+			assignments=assignments,
+			iteration=iteration,
+			distance=distance,
+		)
+	os.rename(tmp_fname, fname)
+
+def read_checkpoint(fname):
+	'''
+	Loads a checkpoint written by write_checkpoint, as a dict keyed by the argument names
+	of write_checkpoint.
+	'''
+	with np.load(fname) as data:
+		state = dict((name, data[name]) for name in data.files)
+	state['iteration'] = int(state['iteration'])
+	state['distance'] = float(state['distance'])
+	return state
+
+class StreamingKMeans(object):
+	def __init__(self, distance_threshold=2 * DISTANCE_THRESHOLD, bearing_threshold=BEARING_THRESHOLD, spawn_distance=DISTANCE_THRESHOLD, decay=1.0, maintenance_interval=10, split_distance=DISTANCE_THRESHOLD, merge_distance=SEED_DISTANCE, seed=None):
+		'''
+		Mini-batch k-means over markers that arrive in batches, for trip feeds too large to
+		hold at once. Only per-cluster state is kept between batches.
+
+		Each batch is assigned to the current clusters as in kmeans, except that markers
+		with no cluster within spawn_distance and bearing_threshold seed new clusters as in
+		initialize_clusters. Every cluster then moves toward the mean of its members in the
+		batch by their share of all markers the cluster has seen, so its learning rate
+		decays as it matures. decay multiplies those counts before every batch; below 1, it
+		keeps clusters following roads that change.
+
+		Every maintenance_interval batches, clusters whose standard deviation along their
+		principal axis exceeds split_distance are split in two, and pairs of clusters within
+		merge_distance and bearing_threshold of each other are merged.
+
+		Transitions between the clusters of consecutive markers of a trace are counted as
+		batches arrive, so that graph can be called at any time.
+		'''
+		self.distance_threshold = distance_threshold
+		self.bearing_threshold = bearing_threshold
+		self.spawn_distance = spawn_distance
+		self.decay = decay
+		self.maintenance_interval = maintenance_interval
+		self.split_distance = split_distance
+		self.merge_distance = merge_distance
+		self.random = random.Random(seed)
+
+		self.positions = np.zeros((0, 2))
+		# mean unit vector of the member bearings
+		self.directions = np.zeros((0, 2))
+		# xx, yy and xy components of the member position covariance
+		self.covariances = np.zeros((0, 3))
+		self.counts = np.zeros(0)
+		# (src cluster, dst cluster) -> number of transitions
+		self.transitions = {}
+		self.batches = 0
+
+	def __len__(self):
+		return len(self.counts)
+
+	def bearings(self):
+		'''
+		Returns the bearing of every cluster as an array.
+		'''
+		return np.degrees(np.arctan2(self.directions[:, 1], self.directions[:, 0]))
+
+	def add_traces(self, traces, seed_distance=SEED_DISTANCE):
 		'''
-		Returns a similarity metric between the specified cluster and marker.
-		
-		A lower value indicates greater similarity.
+		Generates markers for a batch of traces with get_marker_arrays and feeds them to
+		partial_fit_arrays.
 		'''
-		distance = marker.distance_to(cluster)
-		angle_difference = marker.angle_to(cluster)
-		return distance + angle_difference
+		return self.partial_fit_arrays(*get_marker_arrays(traces, seed_distance))
 
-	def recompute_clusters(prev_clusters):
+	def partial_fit(self, markers_by_trace):
+		'''
+		Updates the clusters with one batch of markers, given as returned by get_markers.
 		'''
-		Return a list of new clusters, and the sum of the distances that clusters moved.
+		markers = [marker for trace_markers in markers_by_trace for marker in trace_markers]
+		trace_offsets = np.concatenate([[0], np.cumsum([len(trace_markers) for trace_markers in markers_by_trace])]).astype(np.int64)
+		xs = np.array([marker.x for marker in markers], dtype=np.float64)
+		ys = np.array([marker.y for marker in markers], dtype=np.float64)
+		bearings = np.array([marker.bearing for marker in markers], dtype=np.float64)
+		return self.partial_fit_arrays(xs, ys, bearings, trace_offsets)
+
+	def partial_fit_arrays(self, xs, ys, bearings, trace_offsets):
 		'''
-                new_clusters = []
-                total_distance_moved = 0
-		for cluster in prev_clusters:
-                    new_cluster = Cluster(cluster.get_mean())
-                    new_clusters.append(new_cluster)
-                    total_distance_moved += new_cluster.center.distance_to(cluster.center)
+		Updates the clusters with one batch of markers, given as returned by
+		get_marker_arrays.
 
-                return new_clusters, total_distance_moved
+		Returns the cluster assigned to each marker of the batch. Cluster positions refer
+		to the clusters before any split or merge that ends the batch.
+		'''
+		marker_positions = np.column_stack([xs, ys]).astype(np.float64).reshape(-1, 2)
+		marker_bearings = np.asarray(bearings, dtype=np.float64)
+		assignments = self._assign(marker_positions, marker_bearings)
+		self._update(assignments, marker_positions, marker_bearings)
+		self._count_transitions(assignments, np.asarray(trace_offsets))
+		self.batches += 1
+		if self.maintenance_interval and self.batches % self.maintenance_interval == 0:
+			self.merge()
+			self.split()
+		return assignments
 
+	def _assign(self, marker_positions, marker_bearings):
+		'''
+		Returns the cluster for every marker, creating clusters for markers with no similar
+		cluster nearby.
+		'''
+		assignments = np.empty(len(marker_positions), dtype=np.int64)
+		assignments.fill(-1)
+		matched = np.zeros(len(marker_positions), dtype=bool)
+		if len(self) and len(marker_positions):
+			bearings = self.bearings()
+			index = Index(self.positions.copy(), backend='grid', cell_size=self.distance_threshold)
+			offsets, candidates, _ = index.nearby_many(marker_positions, self.spawn_distance)
+			owners = np.repeat(np.arange(len(marker_positions)), np.diff(offsets))
+			similar = bearing_difference(marker_bearings[owners], bearings[candidates]) <= self.bearing_threshold
+			matched[owners[similar]] = True
+			assignments[matched] = assign_markers(index, bearings, marker_positions[matched], marker_bearings[matched], self.distance_threshold)
 
+		unmatched = np.flatnonzero(~matched)
+		if len(unmatched):
+			points = [Point(x, y, bearing) for (x, y), bearing in zip(marker_positions[unmatched].tolist(), marker_bearings[unmatched].tolist())]
+			seeds = initialize_clusters(points, self.spawn_distance, self.bearing_threshold, seed=self.random.getrandbits(32))
+			assignments[unmatched] = len(self) + seeds.assignments
+			self._append(seeds.positions, seeds.bearings)
+		return assignments
 
-	def assign_members(cluster_index, markers):
+	def _append(self, positions, bearings, covariances=None, counts=None):
 		'''
-		Assign each marker point to the closest cluster.
+		Adds clusters at the given positions and bearings.
 		'''
-		# your code here
-                for marker in markers:
-                    nearby_clusters = cluster_index.nearby(marker, distance_threshold)
-                    best_cluster = min(nearby_clusters, key= lambda cluster: similarity_metric(cluster, marker))
-                    best_cluster.add_member(marker)
+		radians = np.radians(bearings)
+		self.positions = np.vstack([self.positions, positions])
+		self.directions = np.vstack([self.directions, np.column_stack([np.cos(radians), np.sin(radians)])])
+		self.covariances = np.vstack([self.covariances, np.zeros((len(positions), 3)) if covariances is None else covariances])
+		self.counts = np.concatenate([self.counts, np.zeros(len(positions)) if counts is None else counts])
 
+	def _update(self, assignments, marker_positions, marker_bearings):
+		'''
+		Moves every cluster toward the mean of its members in the batch.
+		'''
+		count = len(self)
+		sizes = np.bincount(assignments, minlength=count).astype(np.float64)
+		self.counts *= self.decay
+		self.counts += sizes
+		seen = np.flatnonzero(sizes)
+		rates = (sizes[seen] / self.counts[seen])[:, np.newaxis]
 
-	clusters = initial_clusters
-	distance = float('inf')
-	while distance >= movement_threshold:
-		clusters, distance = recompute_clusters(clusters)
-		index = Index(clusters)
-		assign_members(index, markers)
-		print 'moved clusters distance={}'.format(distance)
-	return clusters
+		def batch_means(weights):
+			return np.column_stack([np.bincount(assignments, weights=w, minlength=count)[seen] for w in weights]) / sizes[seen][:, np.newaxis]
+
+		radians = np.radians(marker_bearings)
+		self.positions[seen] += rates * (batch_means(marker_positions.T) - self.positions[seen])
+		self.directions[seen] += rates * (batch_means([np.cos(radians), np.sin(radians)]) - self.directions[seen])
+		deltas = marker_positions - self.positions[assignments]
+		spread = batch_means([deltas[:, 0] ** 2, deltas[:, 1] ** 2, deltas[:, 0] * deltas[:, 1]])
+		self.covariances[seen] += rates * (spread - self.covariances[seen])
+
+	def _count_transitions(self, assignments, trace_offsets):
+		'''
+		Adds the transitions between clusters of consecutive markers in each trace.
+		'''
+		srcs, dsts, counts = count_transitions(assignments, trace_offsets, len(self))
+		for pair, n in zip(zip(srcs.tolist(), dsts.tolist()), counts.tolist()):
+			self.transitions[pair] = self.transitions.get(pair, 0) + n
+
+	def split(self):
+		'''
+		Splits every cluster whose standard deviation along its principal axis exceeds
+		split_distance into two clusters half a deviation either side of its center.
+		'''
+		xx, yy, xy = self.covariances.T
+		variances = (xx + yy) / 2 + np.sqrt(((xx - yy) / 2) ** 2 + xy ** 2)
+		wide = np.flatnonzero(variances > self.split_distance ** 2)
+		if not len(wide):
+			return
+		angles = np.arctan2(2 * xy[wide], xx[wide] - yy[wide]) / 2
+		steps = np.column_stack([np.cos(angles), np.sin(angles)]) * (np.sqrt(variances[wide]) / 2)[:, np.newaxis]
+		self.counts[wide] /= 2
+		self.covariances[wide] /= 4
+		bearings = self.bearings()[wide]
+		self._append(self.positions[wide] + steps, bearings, self.covariances[wide], self.counts[wide])
+		self.positions[wide] -= steps
+
+	def merge(self):
+		'''
+		Merges pairs of clusters within merge_distance and bearing_threshold of each other,
+		closest pairs first and at most one merge per cluster, and renumbers the clusters.
+		'''
+		if len(self) < 2:
+			return
+		bearings = self.bearings()
+		index = Index(self.positions.copy(), backend='grid', cell_size=self.merge_distance)
+		offsets, candidates, distances = index.nearby_many(self.positions, self.merge_distance)
+		owners = np.repeat(np.arange(len(self)), np.diff(offsets))
+		pairs = (owners < candidates) & (bearing_difference(bearings[owners], bearings[candidates]) <= self.bearing_threshold)
+		order = np.argsort(distances[pairs], kind='mergesort')
+		targets = np.arange(len(self))
+		touched = np.zeros(len(self), dtype=bool)
+		for i, j in zip(owners[pairs][order].tolist(), candidates[pairs][order].tolist()):
+			if touched[i] or touched[j]:
+				continue
+			touched[i] = touched[j] = True
+			targets[j] = i
+			total = self.counts[i] + self.counts[j]
+			share = self.counts[j] / total if total else 0.5
+			delta = self.positions[j] - self.positions[i]
+			between = np.array([delta[0] ** 2, delta[1] ** 2, delta[0] * delta[1]]) * share * (1 - share)
+			self.covariances[i] += share * (self.covariances[j] - self.covariances[i])
+			self.covariances[i] += between
+			self.positions[i] += share * delta
+			self.directions[i] += share * (self.directions[j] - self.directions[i])
+			self.counts[i] = total
+
+		keep = targets == np.arange(len(self))
+		if keep.all():
+			return
+		renumber = np.cumsum(keep) - 1
+		targets = renumber[targets].tolist()
+		self.positions = self.positions[keep]
+		self.directions = self.directions[keep]
+		self.covariances = self.covariances[keep]
+		self.counts = self.counts[keep]
+		transitions = {}
+		for (src, dst), n in self.transitions.iteritems():
+			pair = (targets[src], targets[dst])
+			if pair[0] != pair[1]:
+				transitions[pair] = transitions.get(pair, 0) + n
+		self.transitions = transitions
+
+	def clusters(self):
+		'''
+		Returns the current clusters as a Clustering without markers.
+		'''
+		return Clustering([], self.positions.copy(), self.bearings(), np.zeros(0, dtype=np.int64))
+
+	def graph(self, min_support=1):
+		'''
+		Returns a Graph with a vertex for every cluster and an edge for every pair of
+		clusters with at least min_support transitions, as in generate_edges.
+		'''
+		graph = Graph()
+		vertices = [graph.add_vertex(x, y) for x, y in self.positions.tolist()]
+		for (src, dst), n in sorted(self.transitions.iteritems()):
+			if n >= min_support:
+				graph.add_edge(vertices[src], vertices[dst]).support = n
+		return graph
 
-def generate_edges(graph, markers_by_trace, clusters):
+def count_transitions(assignments, trace_offsets, count):
+	'''
+	Counts the transitions between clusters of consecutive markers within each trace.
+
+	assignments gives the cluster of every marker, with the markers of trace t at
+	trace_offsets[t] to trace_offsets[t + 1] - 1, and count is the number of clusters.
+	Markers without a cluster (-1) and consecutive markers in the same cluster make no
+	transition. Returns (srcs, dsts, counts) arrays with one entry per distinct pair,
+	sorted by source and then destination.
+	'''
+	assignments = np.asarray(assignments, dtype=np.int64)
+	trace_offsets = np.asarray(trace_offsets)
+	if len(assignments) < 2:
+		empty = np.zeros(0, dtype=np.int64)
+		return empty, empty, empty
+	srcs = assignments[:-1]
+	dsts = assignments[1:]
+	keep = (srcs != dsts) & (srcs >= 0) & (dsts >= 0)
+	# pair i joins markers i and i + 1, so the pair before each trace start crosses traces
+	starts = trace_offsets[(trace_offsets > 0) & (trace_offsets < len(assignments))]
+	keep[starts - 1] = False
+	keys, counts = np.unique(srcs[keep] * count + dsts[keep], return_counts=True)
+	return keys // count, keys % count, counts
+
+def generate_edges(graph, markers_by_trace, clusters, min_support=1):
 	'''
 	Connects clusters that appear consecutively in a trace.
 	
 	graph is a road network graph where each cluster is a vertex but no edges have been
 	added yet. markers_by_trace is a list, where the i-th element is the list of markers
 	for trace i. clusters is the final clusters returned by kmeans above, but each cluster
-	will have an additional vertex field.
+	will have an additional vertex field. For a Clustering, the marker to cluster map is
+	its assignment array; for a list of clusters, it is built from their members.
 	
-	You can use graph.add_edge(src_cluster.vertex, dst_cluster.vertex) to create an
-	edge.
+	Each pair of clusters gets a single edge, whose support field is the number of times
+	a trace moves from the first cluster to the second; pairs with less than min_support
+	transitions get no edge. Edges are added in order of source and then destination
+	cluster.
 	
 	You don't need to return anything, just update the graph.
 	'''
-	def get_marker_cluster_map(clusters):
-		'''
-		Returns a map from marker ID to the cluster that the marker has been assigned to.
-		'''
-		m = {}
-		for cluster in clusters:
-			for member in cluster.members:
-				m[member.id] = cluster
-		return m
+	marker_ids = np.array([marker.id for trace_markers in markers_by_trace for marker in trace_markers], dtype=np.int64)
+	trace_offsets = np.concatenate([[0], np.cumsum([len(trace_markers) for trace_markers in markers_by_trace])])
+	if isinstance(clusters, Clustering):
+		assignments = clusters.cluster_of(marker_ids)
+	else:
+		# map marker IDs to cluster positions in one lookup array
+		member_ids = np.array([member.id for cluster in clusters for member in cluster.members], dtype=np.int64)
+		member_clusters = np.repeat(np.arange(len(clusters)), [len(cluster.members) for cluster in clusters])
+		cluster_of = np.empty(max(member_ids.max() if len(member_ids) else -1, marker_ids.max() if len(marker_ids) else -1) + 1, dtype=np.int64)
+		cluster_of.fill(-1)
+		cluster_of[member_ids] = member_clusters
+		assignments = cluster_of[marker_ids]
 
-        marker_cluster_map = get_marker_cluster_map(clusters)
-
-
-        for trace_markers in markers_by_trace:
-            for i in range(1, len(trace_markers)):
-                cluster_one = marker_cluster_map[trace_markers[i-1].id]
-                cluster_two = marker_cluster_map[trace_markers[i].id]
-                if cluster_one != cluster_two:
-                    graph.add_edge(cluster_one.vertex, cluster_two.vertex)
+	srcs, dsts, counts = count_transitions(assignments, trace_offsets, len(clusters))
+	for src, dst, n in zip(srcs.tolist(), dsts.tolist(), counts.tolist()):
+		if n >= min_support:
+			graph.add_edge(clusters[src].vertex, clusters[dst].vertex).support = n
 
 '''
 You can use the code below to run manually.
@@ -267,28 +1018,87 @@ graph.write('kmeans-inferred.graph')
 '''
 
 if __name__ == "__main__":
-	import sys
-	
-	if len(sys.argv) < 2:
-		print 'usage: infer_kmeans.py path_to_trips/'
+	import sys, getopt
+
+	usage = 'usage: infer_kmeans.py [-s <seed>] [-c <checkpoint_file>] [-i <checkpoint_interval>] [-r <checkpoint_to_resume>] [-g <previous_graph>] [-m <min_support>] path_to_trips/'
+	opts, args = getopt.getopt(sys.argv[1:], 's:c:i:r:g:m:h', ['seed=', 'checkpoint=', 'checkpoint-interval=', 'resume=', 'graph=', 'min-support=', 'help'])
+	seed = None
+	checkpoint_file = CHECKPOINT_FILE
+	checkpoint_interval = CHECKPOINT_INTERVAL
+	resume = None
+	previous_graph = None
+	min_support = MIN_SUPPORT
+	for o, a in opts:
+		if o in ('-s', '--seed'):
+			seed = int(a)
+		elif o in ('-c', '--checkpoint'):
+			checkpoint_file = a
+		elif o in ('-i', '--checkpoint-interval'):
+			checkpoint_interval = int(a)
+		elif o in ('-r', '--resume'):
+			resume = a
+		elif o in ('-g', '--graph'):
+			previous_graph = a
+		elif o in ('-m', '--min-support'):
+			min_support = int(a)
+		elif o in ('-h', '--help'):
+			print usage
+			sys.exit(0)
+
+	if (not args and resume is None) or (previous_graph is not None and (resume is not None or not args)):
+		print usage
+		print 'with --resume and no path_to_trips/, the run continues on the checkpoint\'s markers;'
+		print 'with both, the checkpoint\'s clusters are a warm start for the new trips'
+		print '--graph warm-starts from the vertices of a previously inferred graph instead'
 		sys.exit(0)
 
-	# load traces
-	traces = read_traces(sys.argv[1])
-	
-	# get initial markers
-	markers_by_trace = get_markers(traces, SEED_DISTANCE)
-	flat_markers = [marker for trace_markers in markers_by_trace for marker in trace_markers]
-	
-	# initialize clusters and run k-means
-	initial_clusters = initialize_clusters(flat_markers, DISTANCE_THRESHOLD, BEARING_THRESHOLD)
-	clusters = kmeans(flat_markers, initial_clusters, 2 * DISTANCE_THRESHOLD, MOVEMENT_THRESHOLD)
+	iteration = 0
+	distance = float('inf')
+	if args:
+		# load traces and get initial markers
+		traces = read_traces(args[0], cache_dir='cache')
+		xs, ys, marker_bearings, trace_offsets = get_marker_arrays(traces, SEED_DISTANCE)
+		marker_positions = np.column_stack([xs, ys])
+		markers_by_trace = markers_from_arrays(xs, ys, marker_bearings, trace_offsets)
+		flat_markers = [marker for trace_markers in markers_by_trace for marker in trace_markers]
+		if resume is None and previous_graph is None:
+			initial_clusters = initialize_clusters(flat_markers, DISTANCE_THRESHOLD, BEARING_THRESHOLD, seed)
+			positions, bearings, assignments = cluster_arrays(flat_markers, initial_clusters)
+		else:
+			if previous_graph is not None:
+				# the cluster bearings saved with the graph, when there are any, make the
+				# warm start converge in a couple of iterations
+				positions, bearings = graph_cluster_arrays(read_graph(previous_graph), read_cluster_bearings(previous_graph + '.bearings'))
+			else:
+				state = read_checkpoint(resume)
+				positions, bearings = state['positions'], state['bearings']
+			assignments = np.empty(len(flat_markers), dtype=np.int64)
+			assignments.fill(-1)
+	else:
+		state = read_checkpoint(resume)
+		marker_positions, marker_bearings, trace_offsets = state['marker_positions'], state['marker_bearings'], state['trace_offsets']
+		positions, bearings, assignments = state['positions'], state['bearings'], state['assignments']
+		iteration, distance = state['iteration'], state['distance']
+		markers_by_trace = markers_from_arrays(marker_positions[:, 0], marker_positions[:, 1], marker_bearings, trace_offsets)
+		flat_markers = [marker for trace_markers in markers_by_trace for marker in trace_markers]
+
+	def checkpoint(iteration, distance, positions, bearings, assignments):
+		if iteration % checkpoint_interval == 0 or distance < MOVEMENT_THRESHOLD:
+			write_checkpoint(checkpoint_file, marker_positions, marker_bearings, trace_offsets, positions, bearings, assignments, iteration, distance)
+
+	# run k-means, unless the resumed run had already converged
+	if distance >= MOVEMENT_THRESHOLD:
+		positions, bearings, assignments = kmeans_arrays(marker_positions, marker_bearings, positions, bearings, assignments, 2 * DISTANCE_THRESHOLD, MOVEMENT_THRESHOLD, processes=None, tolerance=0, checkpoint=checkpoint, iteration=iteration)
+	clusters = Clustering(flat_markers, positions, bearings, assignments)
 	
 	# extract road network
 	graph = Graph()
 	for cluster in clusters:
 		cluster.vertex = graph.add_vertex(cluster.x, cluster.y)
-	generate_edges(graph, markers_by_trace, clusters)
+	generate_edges(graph, markers_by_trace, clusters, min_support)
 	
-	# output graph
+	# output graph, with the support of each edge alongside so later tools can filter on it,
+	# and the bearing of each cluster so that --graph can warm-start from it
 	graph.write('kmeans-inferred.graph')
+	graph.write_support('kmeans-inferred.graph.support')
+	write_cluster_bearings('kmeans-inferred.graph.bearings', clusters.bearings)
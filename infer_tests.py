@@ -1,5 +1,11 @@
-from util import Trace, Observation, Point, PointWithID, Index, Graph, vector_angle
-from infer_kmeans import Cluster, get_markers, initialize_clusters, kmeans
+from util import Trace, TraceStore, Observation, Point, PointWithID, Index, Graph, vector_angle, bearing_difference, read_graph, CSRGraph, read_traces, iter_traces, write_trace_pack, open_trace_pack, read_trace_pack_key, trace_files_key, list_trace_files
+import math
+import os
+import shutil
+import tempfile
+from infer_kmeans import Cluster, Clustering, StreamingKMeans, get_markers, get_marker_arrays, initialize_clusters, kmeans, kmeans_arrays, generate_edges, cluster_means, marker_arrays, cluster_arrays, write_checkpoint, read_checkpoint, graph_cluster_arrays, clusters_from_graph, write_cluster_bearings, read_cluster_bearings
+import numpy as np
+from infer_kde_lib import MapGrid, TiledMap, rasterize_trips, map_cache_path, write_map_cache, build_map_cache, open_map_cache, gaussian_blur, blur_map, blur_maps, threshold_map, line_pixels, sector_support
 
 def float_equals(a, b, epsilon=0.00001):
 	return abs(a - b) < epsilon
@@ -23,6 +29,252 @@ def test_get_markers():
 	if expected_markers:
 		print 'test_get_markers: expected get_markers to return markers at {}'.format(expected_markers[0])
 
+def test_get_marker_arrays():
+	# a repeated observation adds a zero-length segment, which must not receive markers
+	traces = [
+		Trace([Observation(0, 0), Observation(0, 0), Observation(0, 50), Observation(50, 50)]),
+		Trace([Observation(5, 5)]),
+		Trace([Observation(0, 0), Observation(-40, 0)]),
+	]
+	xs, ys, bearings, trace_offsets = get_marker_arrays(traces, 30)
+	if list(trace_offsets) != [0, 4, 4, 6]:
+		print 'test_get_marker_arrays: expected trace offsets [0, 4, 4, 6], got {}'.format(list(trace_offsets))
+		return
+	expected_markers = [Point(0, 0, 90), Point(0, 30, 90), Point(10, 50, 0), Point(40, 50, 0), Point(0, 0, 180), Point(-30, 0, 180)]
+	for i, expected in enumerate(expected_markers):
+		if not point_equals(Point(xs[i], ys[i], bearings[i]), expected):
+			print 'test_get_marker_arrays: expected marker {} at {}'.format(i, expected)
+
+def test_trace_store():
+	traces = [
+		Trace([Observation(0, 0), Observation(0, 50), Observation(50, 50)]),
+		Trace([]),
+		Trace([Observation(10, -5), Observation(13, -1)]),
+	]
+	store = TraceStore.from_traces(traces)
+	if len(store) != 3 or store.observation_count() != 5:
+		print 'test_trace_store: expected 3 traces with 5 observations'
+	lengths = store.trace_lengths()
+	for i, expected in enumerate([100, 0, 5]):
+		if not float_equals(lengths[i], expected):
+			print 'test_trace_store: expected trace {} to have length {}, got {}'.format(i, expected, lengths[i])
+	r = store.bounds()
+	if not (point_equals(r.min_point, Point(0, -5, 0)) and point_equals(r.max_point, Point(50, 50, 0))):
+		print 'test_trace_store: unexpected bounds {} {}'.format(r.min_point, r.max_point)
+	r = store[2].bounds()
+	if not (point_equals(r.min_point, Point(10, -5, 0)) and point_equals(r.max_point, Point(13, -1, 0))):
+		print 'test_trace_store: unexpected bounds for trace 2 {} {}'.format(r.min_point, r.max_point)
+	if len(store[1:]) != 2 or not float_equals(store[1:].trace_lengths()[1], 5):
+		print 'test_trace_store: expected slicing to keep trace lengths'
+
+def write_trace_dir(dir, traces):
+	for i, trace in enumerate(traces):
+		with open(os.path.join(dir, '{}.txt'.format(i)), 'w') as f:
+			for x, y, timestamp in trace:
+				f.write('{} {} {}\n'.format(x, y, timestamp))
+
+def store_equals(a, b):
+	return np.array_equal(a.offsets - a.offsets[0], b.offsets - b.offsets[0]) and all(np.array_equal(x, y) for x, y in zip(a.columns(), b.columns()))
+
+def test_read_traces():
+	trip_dir = tempfile.mkdtemp()
+	try:
+		write_trace_dir(trip_dir, [[(i, j, 100 + j) for j in xrange(i % 4)] for i in xrange(12)])
+		with open(os.path.join(trip_dir, 'notes.csv'), 'w') as f:
+			f.write('not a trace\n')
+		# files are taken in natural order, so 2.txt comes before 10.txt
+		store = read_traces(trip_dir, pattern='*.txt', processes=1)
+		if len(store) != 12 or [len(trace) for trace in store] != [i % 4 for i in xrange(12)]:
+			print 'test_read_traces: unexpected trace lengths {}'.format([len(trace) for trace in store])
+		if not store_equals(read_traces(trip_dir, pattern='*.txt', processes=3), store):
+			print 'test_read_traces: expected reading in parallel to match reading serially'
+		if [len(trace) for trace in iter_traces(trip_dir, pattern='*.txt', processes=3)] != [i % 4 for i in xrange(12)]:
+			print 'test_read_traces: expected iter_traces to yield traces in file order'
+		if not store_equals(read_traces(trip_dir, pattern='*.txt', max_trips=5, processes=1), store[:5]):
+			print 'test_read_traces: expected max_trips to keep the first traces'
+		if len(read_traces(trip_dir, pattern='1*.txt', processes=1)) != 3:
+			print 'test_read_traces: expected pattern to select 1.txt, 10.txt and 11.txt'
+
+		# lines may differ in their columns, as the timestamp is optional
+		with open(os.path.join(trip_dir, '0.txt'), 'w') as f:
+			f.write('1 2 3\n4 5\n\n6 7 8\n')
+		xs, ys, timestamps = read_traces(trip_dir, pattern='0.txt', processes=1).columns()
+		if list(xs) != [1, 4, 6] or list(ys) != [2, 5, 7] or timestamps[0] != 3 or not np.isnan(timestamps[1]):
+			print 'test_read_traces: unexpected columns {} {} {}'.format(xs, ys, timestamps)
+		with open(os.path.join(trip_dir, '0.txt'), 'w') as f:
+			f.write('1 2 3\n4\n')
+		try:
+			read_traces(trip_dir, pattern='0.txt', processes=1)
+			print 'test_read_traces: expected an error for a truncated line'
+		except ValueError as e:
+			if '0.txt:2' not in str(e):
+				print 'test_read_traces: expected the error to name the file and line, got {}'.format(e)
+	finally:
+		shutil.rmtree(trip_dir)
+
+def test_trace_pack():
+	trip_dir = tempfile.mkdtemp()
+	cache_dir = tempfile.mkdtemp()
+	try:
+		write_trace_dir(trip_dir, [[(0.5, 1, 100), (2, 3.25, 104)], [], [(-7, 8, 200)]])
+		store = read_traces(trip_dir, processes=1)
+		fname = os.path.join(cache_dir, 'test.pack')
+		write_trace_pack(store, fname, 'abc')
+		if read_trace_pack_key(fname) != 'abc' or not store_equals(open_trace_pack(fname), store):
+			print 'test_trace_pack: traces changed in a pack'
+		with open(os.path.join(cache_dir, 'other'), 'w') as f:
+			f.write('not a pack')
+		if read_trace_pack_key(os.path.join(cache_dir, 'other')) is not None:
+			print 'test_trace_pack: expected no key for a file that is not a pack'
+		shutil.rmtree(cache_dir)
+
+		files = list_trace_files(trip_dir)
+		key = trace_files_key(files)
+		cached = read_traces(trip_dir, processes=1, cache_dir=cache_dir)
+		if not store_equals(cached, store) or not store_equals(read_traces(trip_dir, processes=1, cache_dir=cache_dir), store):
+			print 'test_trace_pack: cached traces differ from parsed ones'
+		# the key follows both the size and the modification time of every file
+		stat = os.stat(files[0])
+		os.utime(files[0], (stat.st_atime, stat.st_mtime + 10))
+		touched_key = trace_files_key(files)
+		write_trace_dir(trip_dir, [[(0.5, 1, 100), (2, 3.25, 104), (4, 4, 108)]])
+		os.utime(files[0], (stat.st_atime, stat.st_mtime + 10))
+		if len(set([key, touched_key, trace_files_key(files)])) != 3:
+			print 'test_trace_pack: expected the key to change with file sizes and times'
+		cached = read_traces(trip_dir, processes=1, cache_dir=cache_dir)
+		if len(cached[0]) != 3 or not store_equals(cached, read_traces(trip_dir, processes=1)):
+			print 'test_trace_pack: expected a changed file to be parsed again'
+		if len(os.listdir(cache_dir)) != 1:
+			print 'test_trace_pack: expected stale packs to be removed, found {}'.format(os.listdir(cache_dir))
+		read_traces(trip_dir, max_trips=2, processes=1, cache_dir=cache_dir)
+		if len(os.listdir(cache_dir)) != 2:
+			print 'test_trace_pack: expected packs of other selections of files to be kept'
+	finally:
+		shutil.rmtree(trip_dir)
+		if os.path.isdir(cache_dir):
+			shutil.rmtree(cache_dir)
+
+def test_graph_formats():
+	graph = Graph()
+	a = graph.add_vertex(0.5, 1)
+	b = graph.add_vertex(-3, 4.25)
+	c = graph.add_vertex(7, 7)
+	graph.add_edge(c, a)
+	graph.add_edge(a, b)
+	graph.add_edge(a, c)
+	fd, fname = tempfile.mkstemp()
+	os.close(fd)
+	try:
+		for write in [graph.write, graph.write_binary]:
+			write(fname)
+			copy = read_graph(fname)
+			if [(v.x, v.y) for v in copy.vertices] != [(v.x, v.y) for v in graph.vertices]:
+				print 'test_graph_formats: vertices changed after {}'.format(write.__name__)
+			if [(e.src.id, e.dst.id) for e in copy.edges] != [(e.src.id, e.dst.id) for e in graph.edges]:
+				print 'test_graph_formats: edges changed after {}'.format(write.__name__)
+			if [e.id for e in copy.vertices[0].out_edges] != [1, 2]:
+				print 'test_graph_formats: adjacency changed after {}'.format(write.__name__)
+	finally:
+		os.remove(fname)
+
+def test_csr_graph():
+	graph = Graph()
+	vertices = [graph.add_vertex(x, y) for x, y in [(0, 0), (3, 4), (3, 0), (10, 0), (6, 4), (-5, -5)]]
+	# a two-way street 0-1, a one-way loop 1 -> 4 -> 3 -> 2 -> 0, a shortcut 0 -> 2 and a
+	# vertex 5 that can only be left
+	for src, dst in [(0, 1), (1, 0), (1, 4), (4, 3), (3, 2), (2, 0), (0, 2), (5, 0)]:
+		graph.add_edge(vertices[src], vertices[dst])
+	fd, fname = tempfile.mkstemp()
+	os.close(fd)
+	try:
+		graphs = [CSRGraph.from_graph(graph)]
+		for write in [graph.write, graph.write_binary]:
+			write(fname)
+			graphs.append(CSRGraph.read(fname))
+	finally:
+		os.remove(fname)
+
+	# brute force all-pairs distances over the object graph
+	n = len(graph.vertices)
+	expected = [[0.0 if i == j else float('inf') for j in xrange(n)] for i in xrange(n)]
+	for edge in graph.edges:
+		expected[edge.src.id][edge.dst.id] = min(expected[edge.src.id][edge.dst.id], edge.length())
+	for k in xrange(n):
+		for i in xrange(n):
+			for j in xrange(n):
+				expected[i][j] = min(expected[i][j], expected[i][k] + expected[k][j])
+
+	for csr in graphs:
+		if csr.vertex_count() != n or csr.edge_count() != len(graph.edges):
+			print 'test_csr_graph: expected {} vertices and {} edges'.format(n, len(graph.edges))
+			continue
+		for vertex in graph.vertices:
+			if list(csr.out_edges(vertex.id)) != [edge.id for edge in vertex.out_edges] or list(csr.in_edges(vertex.id)) != [edge.id for edge in vertex.in_edges]:
+				print 'test_csr_graph: adjacency of vertex {} differs from the graph'.format(vertex.id)
+			if [(edge, dst) for edge, dst, _ in csr.out_lists()[vertex.id]] != [(edge.id, edge.dst.id) for edge in vertex.out_edges]:
+				print 'test_csr_graph: out_lists of vertex {} differs from the graph'.format(vertex.id)
+		if not all(float_equals(csr.edge_lengths[edge.id], edge.length()) for edge in graph.edges):
+			print 'test_csr_graph: unexpected edge lengths {}'.format(csr.edge_lengths)
+		for i in xrange(n):
+			for j in xrange(n):
+				distance = csr.shortest_path_distance(i, j)
+				if expected[i][j] == float('inf'):
+					if distance is not None:
+						print 'test_csr_graph: expected {} to be unreachable from {}, got {}'.format(j, i, distance)
+				elif distance is None or not float_equals(distance, expected[i][j]):
+					print 'test_csr_graph: expected distance {} from {} to {}, got {}'.format(expected[i][j], i, j, distance)
+
+def test_index_backends():
+	points = [PointWithID(i, (i * 37) % 23, (i * 11) % 17, 0) for i in xrange(200)]
+	query = Point(10, 8, 0)
+	expected = sorted(point.id for point in points if query.distance_to(point) < 6)
+	for backend in ['quadtree', 'grid', 'kdtree']:
+		index = Index(points, backend=backend)
+		ids = sorted(point.id for point in index.nearby(query, 6))
+		if ids != expected:
+			print 'test_index_backends: {} backend returned {}, expected {}'.format(backend, ids, expected)
+		nearest = index.nearest(Point(30, 30, 0), k=3)
+		distances = [Point(30, 30, 0).distance_to(point) for point in nearest]
+		expected_distances = sorted(Point(30, 30, 0).distance_to(point) for point in points)[:3]
+		if not all(float_equals(a, b) for a, b in zip(distances, expected_distances)) or len(nearest) != 3:
+			print 'test_index_backends: {} backend nearest returned {}'.format(backend, nearest)
+		if index.nearest(Point(30, 30, 0), max_distance=1):
+			print 'test_index_backends: {} backend nearest ignored max_distance'.format(backend)
+
+	# removing and moving points must keep every backend in step with brute force
+	queries = [Point(10, 8, 0), Point(0, 0, 0), Point(40, 25, 0), Point(-5, 30, 0)]
+	for backend in ['quadtree', 'grid', 'kdtree']:
+		points = [PointWithID(i, (i * 37) % 23, (i * 11) % 17, 0) for i in xrange(200)]
+		index = Index(points, backend=backend, cell_size=4)
+		remaining = list(points)
+		for point in points[::5]:
+			index.remove(point)
+			remaining.remove(point)
+		for i, point in enumerate(points[1::7]):
+			# some points move within the original extent and some far outside it
+			if point.id % 5 != 0:
+				index.move(point, ((i * 13) % 29 - 3, (i * 5) % 41 - 5))
+		for point in points[2::9]:
+			if point.id % 5 != 0:
+				index.remove(point)
+				remaining.remove(point)
+		try:
+			index.remove(points[0])
+			print 'test_index_backends: {} backend removed a point twice'.format(backend)
+		except KeyError:
+			pass
+		if len(index) != len(remaining):
+			print 'test_index_backends: {} backend has {} points, expected {}'.format(backend, len(index), len(remaining))
+		for query in queries:
+			ids = sorted(point.id for point in index.nearby(query, 6))
+			expected = sorted(point.id for point in remaining if query.distance_to(point) < 6)
+			if ids != expected:
+				print 'test_index_backends: {} backend returned {} after updates, expected {}'.format(backend, ids, expected)
+			distances = [query.distance_to(point) for point in index.nearest(query, k=5)]
+			expected_distances = sorted(query.distance_to(point) for point in remaining)[:5]
+			if len(distances) != 5 or not all(float_equals(a, b) for a, b in zip(distances, expected_distances)):
+				print 'test_index_backends: {} backend nearest returned {} after updates, expected {}'.format(backend, distances, expected_distances)
+
 def test_initialize_clusters():
 	points = [
 		PointWithID(0, 0, 0, 30), # cluster 1
@@ -48,6 +300,9 @@ def test_initialize_clusters():
 				b = points[member]
 				print 'test_initialize_clusters: expected points {} and {} to be in the same cluster'.format(a, b)
 				break
+	runs = [initialize_clusters(points, 5, 15, seed=7) for _ in xrange(2)]
+	if [[member.id for member in cluster.members] for cluster in runs[0]] != [[member.id for member in cluster.members] for cluster in runs[1]]:
+		print 'test_initialize_clusters: expected the same seed to give the same clusters'
         print 'you are good'
 
 def test_kmeans():
@@ -100,7 +355,263 @@ def test_kmeans():
 				print 'test_kmeans: expected points {} and {} to be in the same cluster'.format(a, b)
 				print clusters
 				break
+	parallel_clusters = kmeans(points, initial_clusters, 20, 0.01, processes=2)
+	if [[member.id for member in cluster.members] for cluster in parallel_clusters] != [[member.id for member in cluster.members] for cluster in clusters]:
+		print 'test_kmeans: expected processes=2 to give the same clusters, got {}'.format(parallel_clusters)
+	stats = []
+	incremental_clusters = kmeans(points, initial_clusters, 20, 0.01, tolerance=0, stats=stats)
+	if [[member.id for member in cluster.members] for cluster in incremental_clusters] != [[member.id for member in cluster.members] for cluster in clusters]:
+		print 'test_kmeans: expected tolerance=0 to give the same clusters, got {}'.format(incremental_clusters)
+	if not stats or stats[0]['reconsidered'] != len(points) or stats[-1]['distance'] >= 0.01:
+		print 'test_kmeans: unexpected iteration stats {}'.format(stats)
+
+	# resuming from a checkpoint of the second iteration must end where the full run did
+	marker_positions, marker_bearings = marker_arrays(points)
+	positions, bearings, assignments = cluster_arrays(points, initial_clusters)
+	fd, fname = tempfile.mkstemp()
+	os.close(fd)
+	try:
+		def checkpoint(iteration, distance, positions, bearings, assignments):
+			if iteration == 2:
+				write_checkpoint(fname, marker_positions, marker_bearings, np.array([0, len(points)]), positions, bearings, assignments, iteration, distance)
+		final = kmeans_arrays(marker_positions, marker_bearings, positions, bearings, assignments, 20, 0.01, checkpoint=checkpoint)
+		state = read_checkpoint(fname)
+		resumed = kmeans_arrays(state['marker_positions'], state['marker_bearings'], state['positions'], state['bearings'], state['assignments'], 20, 0.01, iteration=state['iteration'])
+		if state['iteration'] != 2 or not all(np.array_equal(a, b) for a, b in zip(final, resumed)):
+			print 'test_kmeans: expected a resumed run to match the full run'
+	finally:
+		os.remove(fname)
+
+def test_cluster_means():
+	assignments = np.array([0, 0, -1, 2])
+	marker_positions = np.array([[0, 0], [2, 4], [100, 100], [5, 5]], dtype=np.float64)
+	marker_bearings = np.array([350, 30, 0, 90], dtype=np.float64)
+	positions = np.array([[1, 1], [7, 7], [0, 0]], dtype=np.float64)
+	bearings = np.array([0, 45, 0], dtype=np.float64)
+	positions, bearings = cluster_means(assignments, marker_positions, marker_bearings, positions, bearings)
+	expected = [(1, 2, 10), (7, 7, 45), (5, 5, 90)]
+	for i, (x, y, bearing) in enumerate(expected):
+		if not float_equals(positions[i, 0], x) or not float_equals(positions[i, 1], y) or not float_equals(bearings[i], bearing):
+			print 'test_cluster_means: expected cluster {} at {} but got {} {}'.format(i, (x, y, bearing), positions[i], bearings[i])
+
+def test_streaming_kmeans():
+	eastbound = Trace([Observation(0, 0), Observation(1000, 0)])
+	westbound = Trace([Observation(1000, 5), Observation(0, 5)])
+	streaming = StreamingKMeans(seed=3)
+	streaming.add_traces([eastbound, westbound])
+	count = len(streaming)
+	streaming.add_traces([eastbound])
+	if not count or len(streaming) != count:
+		print 'test_streaming_kmeans: expected a repeated trace to reuse clusters, got {} then {}'.format(count, len(streaming))
+	graph = streaming.graph()
+	bearings = streaming.bearings()
+	for edge in graph.edges:
+		src, dst = edge.src.id, edge.dst.id
+		if bearing_difference(bearings[src], bearings[dst]) > 45 or (edge.dst.x - edge.src.x) * math.cos(math.radians(bearings[src])) <= 0:
+			print 'test_streaming_kmeans: unexpected edge from {} to {}'.format(streaming.clusters()[src], streaming.clusters()[dst])
+			break
+	if not graph.edges:
+		print 'test_streaming_kmeans: expected edges along the trace'
+
+def test_graph_warm_start():
+	graph = Graph()
+	a = graph.add_vertex(0, 0)
+	b = graph.add_vertex(10, 0)
+	c = graph.add_vertex(10, 10)
+	graph.add_vertex(50, 50)
+	graph.add_edge(a, b)
+	graph.add_edge(b, c)
+	positions, bearings = graph_cluster_arrays(graph)
+	for i, expected in enumerate([0, 45, 90, 0]):
+		if not float_equals(bearings[i], expected):
+			print 'test_graph_warm_start: expected vertex {} to have bearing {}, got {}'.format(i, expected, bearings[i])
+	# on a two-way street the edges cancel out, so the longest outgoing edge decides
+	two_way = Graph()
+	a, b, c = two_way.add_vertex(0, 0), two_way.add_vertex(0, 10), two_way.add_vertex(0, 30)
+	for src, dst in [(a, b), (b, a), (b, c), (c, b)]:
+		two_way.add_edge(src, dst)
+	_, bearings = graph_cluster_arrays(two_way)
+	if not all(float_equals(bearing, expected) for bearing, expected in zip(bearings, [90, 90, -90])):
+		print 'test_graph_warm_start: unexpected two-way street bearings {}'.format(bearings)
+	points = [PointWithID(0, 1, 1, 0), PointWithID(1, 9, 1, 0), PointWithID(2, 11, 9, 90)]
+	clusters = kmeans(points, clusters_from_graph(graph), 5, 0.01)
+	if [[member.id for member in cluster.members] for cluster in clusters] != [[0], [1], [2], []]:
+		print 'test_graph_warm_start: unexpected clusters {}'.format(clusters)
+	elif not point_equals(clusters[0], Point(1, 1, 0)):
+		print 'test_graph_warm_start: expected clusters to move to their members, got {}'.format(clusters)
+
+	# a two-way street: the bearings saved next to the graph bring the clusters of both
+	# lanes back at once, where the edges could not tell the lanes apart
+	points = [PointWithID(i, 10 * (i // 2), 4 * (i % 2), 180 * (i % 2)) for i in xrange(20)]
+	cold = kmeans(points, initialize_clusters(points, 15, 45, seed=1), 15, 0.01)
+	two_way = Graph()
+	for cluster in cold:
+		two_way.add_vertex(cluster.x, cluster.y)
+	fd, fname = tempfile.mkstemp()
+	os.close(fd)
+	try:
+		write_cluster_bearings(fname, cold.bearings)
+		bearings = read_cluster_bearings(fname)
+	finally:
+		os.remove(fname)
+	if read_cluster_bearings(fname) is not None or not np.array_equal(bearings, cold.bearings):
+		print 'test_graph_warm_start: cluster bearings changed in the bearings file'
+	stats = []
+	warm = kmeans(points, clusters_from_graph(two_way, bearings), 15, 0.01, stats=stats)
+	if len(stats) > 2 or [[member.id for member in cluster.members] for cluster in warm] != [[member.id for member in cluster.members] for cluster in cold]:
+		print 'test_graph_warm_start: expected a warm start from saved bearings to converge at once, took {} iterations'.format(len(stats))
+
+def test_generate_edges():
+	markers_by_trace = [
+		[PointWithID(0, 0, 0, 0), PointWithID(1, 10, 0, 0), PointWithID(2, 11, 0, 0)],
+		[PointWithID(3, 0, 1, 0), PointWithID(4, 10, 1, 0)],
+		[PointWithID(5, 10, 2, 180), PointWithID(6, 0, 2, 180)],
+	]
+	markers = [marker for trace_markers in markers_by_trace for marker in trace_markers]
+	clusters = [Cluster(Point(0, 0, 0)), Cluster(Point(10, 0, 0))]
+	for marker_id, cluster in [(0, 0), (1, 1), (2, 1), (3, 0), (4, 1), (5, 1), (6, 0)]:
+		clusters[cluster].add_member(markers[marker_id])
+	for min_support, expected in [(1, [(0, 1, 2), (1, 0, 1)]), (2, [(0, 1, 2)])]:
+		graph = Graph()
+		for cluster in clusters:
+			cluster.vertex = graph.add_vertex(cluster.x, cluster.y)
+		generate_edges(graph, markers_by_trace, clusters, min_support)
+		edges = [(edge.src.id, edge.dst.id, edge.support) for edge in graph.edges]
+		if edges != expected:
+			print 'test_generate_edges: expected edges {} with min_support={}, got {}'.format(expected, min_support, edges)
+
+	# support is written next to the graph and read back onto its edges
+	fd, fname = tempfile.mkstemp()
+	os.close(fd)
+	try:
+		graph.write_support(fname)
+		for edge in graph.edges:
+			edge.support = None
+		graph.read_support(fname)
+		if [edge.support for edge in graph.edges] != [2]:
+			print 'test_generate_edges: support changed in the support file'
+	finally:
+		os.remove(fname)
+
+def test_clustering():
+	markers = [PointWithID(10, 0, 0, 0), PointWithID(11, 1, 0, 0), PointWithID(12, 5, 5, 90), PointWithID(13, 9, 9, 0)]
+	clustering = Clustering(markers, [[0, 0], [5, 5]], [0, 90], [1, 0, 1, -1])
+	if list(clustering.counts) != [1, 2] or [[member.id for member in cluster.members] for cluster in clustering] != [[11], [10, 12]]:
+		print 'test_clustering: unexpected clusters {}'.format(clustering)
+	if list(clustering.cluster_of([12, 13, 10, 99])) != [1, -1, 1, -1]:
+		print 'test_clustering: unexpected cluster_of {}'.format(list(clustering.cluster_of([12, 13, 10, 99])))
+	clustering[0].add_member(markers[3])
+	if [member.id for member in clustering[0].members] != [11, 13] or list(clustering.counts) != [1, 2]:
+		print 'test_clustering: expected add_member to only change the view'
+
+def test_rasterize_trips():
+	grid = MapGrid(0, 0, 20, 10, 1.0, 1.0)
+	# the first trip covers row 5 twice, once each way; the second crosses it diagonally
+	there_and_back = Trace([Observation(1, 5), Observation(10, 5), Observation(1, 5)])
+	diagonal = Trace([Observation(1, 5), Observation(10, 8)])
+	themap, sector_maps = rasterize_trips([there_and_back, Trace([]), diagonal], grid)
+	if list(themap[5, 1:11]) != [64, 53, 43, 32, 32, 32, 32, 32, 32, 32] or themap[5, 11] != 0:
+		print 'test_rasterize_trips: unexpected row {}'.format(list(themap[5]))
+	if themap[2, 9] + themap[3, 9] != 32 or themap.sum() != 32 * 10 + 32 * 10:
+		print 'test_rasterize_trips: expected the diagonal trip to add 32 per column, got {}'.format(themap)
+	# rows grow southward, so the eastbound and diagonal segments are in sector 2 and the
+	# westbound one in sector 6
+	if [int(sector_map.sum()) for sector_map in sector_maps] != [0, 0, 640, 0, 0, 0, 320, 0]:
+		print 'test_rasterize_trips: unexpected sector totals {}'.format([int(sector_map.sum()) for sector_map in sector_maps])
+
+	cache_dir = tempfile.mkdtemp()
+	trip_dir = tempfile.mkdtemp()
+	try:
+		write_trace_dir(trip_dir, [[(0, 0, 100), (10, 5, 104)], [(3, 3, 200)]])
+		path = map_cache_path(cache_dir, trip_dir, 2, 2)
+		if path == map_cache_path(cache_dir, trip_dir, 2, 4) or path == map_cache_path(cache_dir, trip_dir, 1, 2):
+			print 'test_rasterize_trips: expected the map cache key to depend on cell size and trip count'
+		if open_map_cache(path) is not None:
+			print 'test_rasterize_trips: expected no map cache before writing one'
+		write_map_cache(path, themap, sector_maps)
+		cached_map, cached_sector_maps = open_map_cache(path)
+		if not np.array_equal(cached_map.to_dense(), themap) or not all(np.array_equal(a.to_dense(), b) for a, b in zip(cached_sector_maps, sector_maps)):
+			print 'test_rasterize_trips: maps changed in the cache'
+		built_map, built_sector_maps = build_map_cache(os.path.join(cache_dir, 'built'), [there_and_back, Trace([]), diagonal], grid, tile_size=4)
+		if not np.array_equal(built_map.to_dense(), themap) or not all(np.array_equal(a.to_dense(), b) for a, b in zip(built_sector_maps, sector_maps)):
+			print 'test_rasterize_trips: expected tiled rasterizing to match the dense maps'
+
+		# rewriting a trip selects a new cache, and building it removes the stale one but
+		# not the cache for another cell size
+		other_path = map_cache_path(cache_dir, trip_dir, 2, 4)
+		write_map_cache(other_path, themap, sector_maps)
+		write_trace_dir(trip_dir, [[(0, 0, 100), (10, 5, 104), (12, 5, 108)]])
+		new_path = map_cache_path(cache_dir, trip_dir, 2, 2)
+		if new_path == path:
+			print 'test_rasterize_trips: expected the map cache key to change with the trips'
+		build_map_cache(new_path, [there_and_back, diagonal], grid, tile_size=4)
+		if os.path.exists(path) or not os.path.isdir(new_path) or not os.path.isdir(other_path):
+			print 'test_rasterize_trips: expected only the stale map cache to be removed, found {}'.format(sorted(os.listdir(cache_dir)))
+	finally:
+		shutil.rmtree(cache_dir)
+		shutil.rmtree(trip_dir)
+
+def test_tiled_map():
+	dense = np.zeros((50, 70), dtype=np.uint16)
+	dense[10, 5:30] = 100
+	dense[40:45, 60] = 65000
+	tiled = TiledMap.from_array(dense, tile_size=16)
+	if tiled.keys() != [(0, 0), (0, 1), (2, 3)] or not np.array_equal(tiled.to_dense(), dense):
+		print 'test_tiled_map: expected 3 tiles holding the array, got {}'.format(tiled.keys())
+	tiled.add(np.array([10, 40, 0]), np.array([5, 60, 0]), np.array([1, 1000, 7]))
+	if list(tiled.values_at([10, 40, 0, -1, 10], [5, 60, 0, 0, 70])) != [101, 65535, 7, 0, 0]:
+		print 'test_tiled_map: unexpected values {}'.format(tiled.values_at([10, 40, 0, -1, 10], [5, 60, 0, 0, 70]))
+	dense = tiled.to_dense()
+	row, col, height, width = tiled.occupied_bounds()
+	if (row, col, height, width) != (0, 0, 48, 64) or tiled.window(row, col, height, width).sum() != dense.sum():
+		print 'test_tiled_map: unexpected occupied bounds {}'.format((row, col, height, width))
+	blurred = blur_map(tiled, 5).to_dense()
+	if not np.array_equal(blurred, np.rint(gaussian_blur(dense, 5))):
+		print 'test_tiled_map: expected tiled blurring to match blurring the dense map'
+	if not all(np.array_equal(a.to_dense(), blurred) for a in blur_maps([tiled, tiled], 5, processes=2)):
+		print 'test_tiled_map: expected blurring in threads to match blurring serially'
+	# only the pixel in the corner loses some of its intensity beyond the map
+	if not dense.sum() - 7 < gaussian_blur(dense, 5).sum() < dense.sum() + 1e-6 or not 0 < blurred[8, 17] < blurred[10, 17] < 100:
+		print 'test_tiled_map: expected blurring to spread intensity without losing it'
+	thresholded = threshold_map(tiled, 100).to_dense()
+	if thresholded.dtype != np.uint8 or list(np.unique(thresholded)) != [0, 255] or np.count_nonzero(thresholded) != 6:
+		print 'test_tiled_map: unexpected thresholded map {}'.format(np.count_nonzero(thresholded))
+	directory = tempfile.mkdtemp()
+	try:
+		tiled.save(directory)
+		loaded = TiledMap.load(directory)
+		if not np.array_equal(loaded.to_dense(), dense) or loaded.max() != 65535 or loaded.min() != 0:
+			print 'test_tiled_map: map changed when saved'
+	finally:
+		shutil.rmtree(directory)
+	lines, cols, rows = line_pixels([(0, 0), (3, 3)], [(5, -2), (3, 3)])
+	if list(lines) != [0, 0, 0, 0, 0, 0, 1] or list(cols) != [0, 1, 2, 3, 4, 5, 3] or list(rows) != [0, 0, -1, -1, -2, -2, 3]:
+		print 'test_tiled_map: unexpected lines {} {} {}'.format(list(lines), list(cols), list(rows))
+
+	# traffic along row 2 toward higher columns is in sector 2, and along column 2 toward
+	# higher rows in sector 0; the diagonal line is in sector 1, next to both
+	sector_maps = [TiledMap(8, 8, 4) for sector in range(8)]
+	sector_maps[2].add(np.array([2] * 8), np.arange(8), np.array([5] * 8))
+	sector_maps[0].add(np.arange(8), np.array([2] * 8), np.array([1] * 8))
+	forward, reverse = sector_support(sector_maps, [(0, 2), (7, 2), (2, 7), (1, 1)], [(7, 2), (0, 2), (2, 0), (3, 3)])
+	if list(forward) != [40, 0, 0, 6] or list(reverse) != [0, 40, 8, 0]:
+		print 'test_tiled_map: unexpected sector support {} {}'.format(list(forward), list(reverse))
 
-test_get_markers()
-test_initialize_clusters()
-test_kmeans()
+if __name__ == '__main__':
+	test_get_markers()
+	test_get_marker_arrays()
+	test_trace_store()
+	test_read_traces()
+	test_trace_pack()
+	test_graph_formats()
+	test_csr_graph()
+	test_index_backends()
+	test_initialize_clusters()
+	test_cluster_means()
+	test_clustering()
+	test_kmeans()
+	test_streaming_kmeans()
+	test_graph_warm_start()
+	test_generate_edges()
+	test_rasterize_trips()
+	test_tiled_map()
@@ -1,12 +1,28 @@
 import math
+import numpy as np
 import pyqtree
 import svgwrite
 import os
 import os.path
+import re
+import fnmatch
+import gc
+import hashlib
+import heapq
+import multiprocessing
+import struct
 
 def vector_angle(x, y):
 	return math.atan2(y, x) - math.atan2(0, 1)
 
+def bearing_difference(a, b):
+	'''
+	Returns the absolute difference in degrees between bearings a and b, in [0, 180].
+
+	Works elementwise on arrays as well as on single bearings.
+	'''
+	return np.abs((b - a + 180) % 360 - 180)
+
 class Point(object):
 	def __init__(self, x, y, bearing):
 		self.x = float(x)
@@ -71,56 +87,987 @@ class Rectangle(object):
 def get_empty_rectangle():
 	return Rectangle(Point(float('inf'), float('inf'), 0), Point(float('-inf'), float('-inf'), 0))
 
+def get_array_rectangle(xs, ys):
+	'''
+	Returns the bounding Rectangle of the points given by coordinate arrays xs and ys.
+	'''
+	if len(xs) == 0:
+		return get_empty_rectangle()
+	return Rectangle(Point(xs.min(), ys.min(), 0), Point(xs.max(), ys.max(), 0))
+
 class Trace(object):
 	def __init__(self, observations):
 		self.observations = observations
+
+	def coordinates(self):
+		'''
+		Returns the x and y positions of the observations as two float64 arrays.
+		'''
+		xs = np.array([obs.x for obs in self.observations], dtype=np.float64)
+		ys = np.array([obs.y for obs in self.observations], dtype=np.float64)
+		return xs, ys
 	
 	def bounds(self):
-		r = get_empty_rectangle()
-		for obs in self.observations:
-			r.extend_to_contain(obs)
-		return r
+		return get_array_rectangle(*self.coordinates())
+
+	def length(self):
+		'''
+		Returns the total distance travelled along the trace.
+		'''
+		xs, ys = self.coordinates()
+		return float(np.hypot(np.diff(xs), np.diff(ys)).sum())
+
+class StoredTrace(Trace):
+	'''
+	A Trace whose observations are slices of the arrays held by a TraceStore.
+
+	No Observation objects exist until the observations attribute is accessed.
+	'''
+	def __init__(self, xs, ys, timestamps):
+		self.xs = xs
+		self.ys = ys
+		self.timestamps = timestamps
+
+	@property
+	def observations(self):
+		return [Observation(x, y) for x, y in zip(self.xs.tolist(), self.ys.tolist())]
+
+	def coordinates(self):
+		return self.xs, self.ys
+
+	def __len__(self):
+		return len(self.xs)
+
+class TraceStore(object):
+	'''
+	Columnar container for a collection of traces.
+
+	The observations of every trace are stored back to back in contiguous float64 arrays
+	xs, ys and timestamps (NaN where the trace file has no timestamp column). Trace i
+	spans xs[offsets[i]:offsets[i + 1]], so offsets has one more entry than there are
+	traces.
+
+	A TraceStore behaves like a list of traces: indexing returns a StoredTrace view,
+	slicing returns a TraceStore sharing the same arrays, and iteration yields views.
+	'''
+	def __init__(self, xs, ys, timestamps, offsets):
+		self.xs = xs
+		self.ys = ys
+		self.timestamps = timestamps
+		self.offsets = offsets
+
+	@staticmethod
+	def from_traces(traces):
+		'''
+		Packs a sequence of Trace objects into a TraceStore.
+		'''
+		columns = [trace.coordinates() for trace in traces]
+		sizes = [len(xs) for xs, _ in columns]
+		offsets = np.zeros(len(columns) + 1, dtype=np.int64)
+		offsets[1:] = np.cumsum(sizes)
+		xs = np.concatenate([xs for xs, _ in columns] + [np.zeros(0)])
+		ys = np.concatenate([ys for _, ys in columns] + [np.zeros(0)])
+		timestamps = np.full(len(xs), np.nan)
+		for i, trace in enumerate(traces):
+			if getattr(trace, 'timestamps', None) is not None:
+				timestamps[offsets[i]:offsets[i + 1]] = trace.timestamps
+		return TraceStore(xs, ys, timestamps, offsets)
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, key):
+		if isinstance(key, slice):
+			start, stop, step = key.indices(len(self))
+			if step != 1:
+				return TraceStore.from_traces([self[i] for i in xrange(start, stop, step)])
+			stop = max(start, stop)
+			return TraceStore(self.xs, self.ys, self.timestamps, self.offsets[start:stop + 1])
+		if key < 0:
+			key += len(self)
+		if key < 0 or key >= len(self):
+			raise IndexError('trace index out of range')
+		start, end = self.offsets[key], self.offsets[key + 1]
+		return StoredTrace(self.xs[start:end], self.ys[start:end], self.timestamps[start:end])
+
+	def __iter__(self):
+		for i in xrange(len(self)):
+			yield self[i]
+
+	def sizes(self):
+		'''
+		Returns the number of observations in each trace.
+		'''
+		return np.diff(self.offsets)
+
+	def observation_count(self):
+		return int(self.offsets[-1] - self.offsets[0])
+
+	def columns(self):
+		'''
+		Returns the xs, ys and timestamps arrays restricted to the traces in this store.
+		'''
+		start, end = self.offsets[0], self.offsets[-1]
+		return self.xs[start:end], self.ys[start:end], self.timestamps[start:end]
+
+	def bounds(self):
+		'''
+		Returns the Rectangle bounding every observation in the store.
+		'''
+		xs, ys, _ = self.columns()
+		return get_array_rectangle(xs, ys)
+
+	def trace_bounds(self):
+		'''
+		Returns per-trace bounds as four arrays (min_x, min_y, max_x, max_y).
+
+		Empty traces get an inverted infinite box, like get_empty_rectangle.
+		'''
+		sizes = self.sizes()
+		nonempty = sizes > 0
+		starts = (self.offsets[:-1] - self.offsets[0])[nonempty]
+		xs, ys, _ = self.columns()
+		bounds = []
+		for values, fill, reduce_op in [(xs, np.inf, np.minimum), (ys, np.inf, np.minimum), (xs, -np.inf, np.maximum), (ys, -np.inf, np.maximum)]:
+			result = np.full(len(self), fill)
+			if len(starts):
+				result[nonempty] = reduce_op.reduceat(values, starts)
+			bounds.append(result)
+		return tuple(bounds)
+
+	def trace_lengths(self):
+		'''
+		Returns the distance travelled along each trace.
+		'''
+		xs, ys, _ = self.columns()
+		starts = self.offsets[:-1] - self.offsets[0]
+		ends = self.offsets[1:] - self.offsets[0]
+		# step[j] is the distance from observation j - 1 to j, or zero where j starts a trace
+		steps = np.zeros(len(xs))
+		steps[1:] = np.hypot(np.diff(xs), np.diff(ys))
+		steps[starts[starts < len(xs)]] = 0
+		cumulative = np.concatenate([[0], np.cumsum(steps)])
+		return cumulative[ends] - cumulative[starts]
+
+def read_trace_file(fname):
+	'''
+	Reads one trace file and returns its x, y and timestamp columns as float64 arrays.
+
+	Each line holds "x y" or "x y timestamp"; timestamps are NaN when absent. Blank lines
+	are skipped, and a line without two numbers raises a ValueError naming the file.
+	'''
+	with open(fname, 'r') as f:
+		text = f.read()
+	first_line = text.strip().split('\n', 1)[0].split()
+	if not first_line:
+		empty = np.zeros(0)
+		return empty, empty.copy(), empty.copy()
+	columns = len(first_line)
+	values = np.fromstring(text, dtype=np.float64, sep=' ')
+	lines = text.split('\n')
+	if len(values) != columns * (len(lines) - lines.count('')):
+		# lines with differing numbers of columns, or text fromstring stopped at
+		values = _parse_trace_lines(fname, lines)
+		columns = 3
+	values = values.reshape(-1, columns)
+	xs = np.ascontiguousarray(values[:, 0])
+	ys = np.ascontiguousarray(values[:, 1])
+	if values.shape[1] > 2:
+		timestamps = np.ascontiguousarray(values[:, 2])
+	else:
+		timestamps = np.full(len(values), np.nan)
+	return xs, ys, timestamps
+
+def _parse_trace_lines(fname, lines):
+	'''
+	Parses trace lines one at a time, for files the fast path in read_trace_file cannot
+	take. Returns the values as a flat array of (x, y, timestamp) triples.
+	'''
+	rows = []
+	for number, line in enumerate(lines):
+		parts = line.split()
+		if not parts:
+			continue
+		try:
+			rows.append((float(parts[0]), float(parts[1]), float(parts[2]) if len(parts) > 2 else np.nan))
+		except (IndexError, ValueError):
+			raise ValueError('{}:{}: malformed trace line {!r}'.format(fname, number + 1, line))
+	return np.array(rows, dtype=np.float64).reshape(-1)
+
+def _natural_key(fname):
+	return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', os.path.basename(fname))]
+
+def list_trace_files(dir, pattern='*', max_trips=None):
+	'''
+	Returns the paths of the trace files in dir whose names match the glob pattern.
+
+	Files are sorted by name with embedded numbers compared numerically (so 2.txt comes
+	before 10.txt), and only the first max_trips are returned if it is set.
+	'''
+	files = [os.path.join(dir, fbase) for fbase in fnmatch.filter(os.listdir(dir), pattern)]
+	files = sorted([fname for fname in files if os.path.isfile(fname)], key=_natural_key)
+	if max_trips is not None:
+		files = files[:max_trips]
+	return files
+
+def iter_traces(dir, pattern='*', max_trips=None, processes=None):
+	'''
+	Yields a StoredTrace for each trace file in dir, in list_trace_files order.
+
+	Files are parsed across a pool of processes worker processes (default: one per CPU),
+	and traces are yielded as soon as they and every earlier file have been parsed, so
+	callers can start consuming before the whole directory is read. With processes=1
+	the files are parsed in this process.
+	'''
+	return iter_trace_files(list_trace_files(dir, pattern, max_trips), processes)
+
+def iter_trace_files(files, processes=None):
+	'''
+	Yields a StoredTrace for each of the given trace files; see iter_traces.
+	'''
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	processes = min(processes, len(files))
+	if processes <= 1:
+		for fname in files:
+			yield StoredTrace(*read_trace_file(fname))
+		return
 
-def read_traces(dir):
-	files = [os.path.join(dir, fbase) for fbase in os.listdir(dir)]
-	files = [fname for fname in files if os.path.isfile(fname)]
-	traces = []
+	pool = multiprocessing.Pool(processes)
+	try:
+		chunksize = max(1, len(files) // (processes * 8))
+		for columns in pool.imap(read_trace_file, files, chunksize):
+			yield StoredTrace(*columns)
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+
+TRACE_PACK_MAGIC = 'TRPK'
+TRACE_PACK_VERSION = 1
+# magic, version, directory key, number of traces, number of observations
+TRACE_PACK_HEADER = struct.Struct('<4sI40sqq')
+
+def trace_files_key(files):
+	'''
+	Returns a hex digest identifying the names, sizes and modification times of files.
+
+	Any trip being added, removed or rewritten changes the key.
+	'''
+	digest = hashlib.sha1()
 	for fname in files:
-		with open(fname, 'r') as f:
-			observations = []
-			for line in f:
-				parts = line.strip().split(' ')
-				observations.append(Observation(float(parts[0]), float(parts[1])))
-			traces.append(Trace(observations))
-	return traces
+		stat = os.stat(fname)
+		digest.update('{} {} {!r}\n'.format(os.path.basename(fname), stat.st_size, stat.st_mtime))
+	return digest.hexdigest()
+
+def write_trace_pack(store, fname, key=''):
+	'''
+	Writes a TraceStore to fname as a binary trace pack.
+
+	The pack is a fixed-size header followed by the offset table (int64) and the x, y and
+	timestamp columns (float64), all little-endian, so open_trace_pack can map it without
+	parsing. The pack is written to a temporary file and renamed into place.
+	'''
+	xs, ys, timestamps = store.columns()
+	offsets = store.offsets - store.offsets[0]
+	tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+	with open(tmp_fname, 'wb') as f:
+		f.write(TRACE_PACK_HEADER.pack(TRACE_PACK_MAGIC, TRACE_PACK_VERSION, key, len(store), len(xs)))
+		for array, dtype in [(offsets, '<i8'), (xs, '<f8'), (ys, '<f8'), (timestamps, '<f8')]:
+			np.ascontiguousarray(array, dtype=dtype).tofile(f)
+	os.rename(tmp_fname, fname)
+
+def read_trace_pack_key(fname):
+	'''
+	Returns the directory key recorded in a trace pack, or None if fname is not a pack.
+	'''
+	with open(fname, 'rb') as f:
+		header = f.read(TRACE_PACK_HEADER.size)
+	if len(header) < TRACE_PACK_HEADER.size:
+		return None
+	magic, version, key, _, _ = TRACE_PACK_HEADER.unpack(header)
+	if magic != TRACE_PACK_MAGIC or version != TRACE_PACK_VERSION:
+		return None
+	return key.rstrip('\0')
+
+def open_trace_pack(fname):
+	'''
+	Opens a trace pack written by write_trace_pack as a read-only, memory-mapped TraceStore.
+	'''
+	with open(fname, 'rb') as f:
+		magic, version, _, n_traces, n_observations = TRACE_PACK_HEADER.unpack(f.read(TRACE_PACK_HEADER.size))
+	if magic != TRACE_PACK_MAGIC or version != TRACE_PACK_VERSION:
+		raise ValueError('{} is not a trace pack'.format(fname))
+	offset = TRACE_PACK_HEADER.size
+	offsets = np.memmap(fname, dtype='<i8', mode='r', offset=offset, shape=(n_traces + 1,))
+	offset += offsets.nbytes
+	columns = []
+	for _ in xrange(3):
+		if n_observations:
+			columns.append(np.memmap(fname, dtype='<f8', mode='r', offset=offset, shape=(n_observations,)))
+		else:
+			columns.append(np.zeros(0))
+		offset += 8 * n_observations
+	return TraceStore(columns[0], columns[1], columns[2], offsets)
+
+def read_traces(dir, pattern='*', max_trips=None, processes=None, cache_dir=None):
+	'''
+	Reads the trace files in dir into a TraceStore.
+
+	See list_trace_files and iter_traces for the meaning of the arguments. If cache_dir is
+	set, the parsed traces are also saved there as a trace pack named after the key of
+	the selected files, and later calls with unchanged files memory-map that pack instead
+	of parsing anything. Writing a new pack deletes the stale packs of the same dir,
+	pattern and max_trips.
+	'''
+	files = list_trace_files(dir, pattern, max_trips)
+	if cache_dir is None:
+		return TraceStore.from_traces(list(iter_trace_files(files, processes)))
+
+	# packs of the same selection of files share a prefix, so a pack made stale by the
+	# files changing can be told apart from the packs of other directories
+	source = hashlib.sha1('{} {} {!r}'.format(os.path.abspath(dir), pattern, max_trips)).hexdigest()[:16]
+	key = trace_files_key(files)
+	pack_fname = os.path.join(cache_dir, 'traces_{}_{}.pack'.format(source, key))
+	if not os.path.isfile(pack_fname) or read_trace_pack_key(pack_fname) != key:
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		store = TraceStore.from_traces(list(iter_trace_files(files, processes)))
+		write_trace_pack(store, pack_fname, key)
+		for fname in fnmatch.filter(os.listdir(cache_dir), 'traces_{}_*.pack'.format(source)):
+			if os.path.join(cache_dir, fname) != pack_fname:
+				os.remove(os.path.join(cache_dir, fname))
+	return open_trace_pack(pack_fname)
+
+class _QuadtreeBackend(object):
+	'''
+	Index backend over a pyqtree quadtree; each point is stored as a unit square.
+	'''
+	def __init__(self, xs, ys, cell_size=None):
+		self.xs = xs
+		self.ys = ys
+		min_x, min_y = (xs.min(), ys.min()) if len(xs) else (0, 0)
+		max_x, max_y = (xs.max(), ys.max()) if len(xs) else (0, 0)
+		self.bbox = (min_x - 1, min_y - 1, max_x + 1, max_y + 1)
+		self.tree = pyqtree.Index(bbox=self.bbox)
+		# points moved outside the bounding box of the tree; pyqtree would file them under
+		# quads that do not contain them, so they are kept aside and always checked
+		self.outside = set()
+		for slot, (x, y) in enumerate(zip(xs.tolist(), ys.tolist())):
+			self.tree.insert(slot, (x - 0.5, y - 0.5, x + 0.5, y + 0.5))
+
+	def _rect(self, slot):
+		x, y = self.xs.item(slot), self.ys.item(slot)
+		return (x - 0.5, y - 0.5, x + 0.5, y + 0.5)
+
+	def _fits(self, slot):
+		rect = self._rect(slot)
+		return rect[0] >= self.bbox[0] and rect[1] >= self.bbox[1] and rect[2] <= self.bbox[2] and rect[3] <= self.bbox[3]
+
+	def remove(self, slot):
+		if slot in self.outside:
+			self.outside.remove(slot)
+		else:
+			self.tree.remove(slot, self._rect(slot))
+
+	def move(self, slot, x, y):
+		self.remove(slot)
+		self.xs[slot] = x
+		self.ys[slot] = y
+		if self._fits(slot):
+			self.tree.insert(slot, self._rect(slot))
+		else:
+			self.outside.add(slot)
+
+	def nearby(self, x, y, distance):
+		candidates = list(self.tree.intersect((x - distance, y - distance, x + distance, y + distance)))
+		candidates.extend(self.outside)
+		return _filter_within(candidates, self.xs, self.ys, x, y, distance)
+
+	def nearby_many(self, xs, ys, distance):
+		return _nearby_many_by_query(self, xs, ys, distance)
+
+	def nearest(self, x, y, k, max_distance):
+		# quads are searched in order of distance; since points are stored as unit squares,
+		# a point can lie up to 0.5 outside the quad holding it
+		seen = set()
+		heap = [(0.0, 0, 0, self.tree)]
+		for slot in self.outside:
+			heap.append((_point_distance(self.xs[slot], self.ys[slot], x, y), 1, len(heap), slot))
+		heapq.heapify(heap)
+		counter = len(heap)
+		found = []
+		while heap and len(found) < k:
+			distance, is_point, _, item = heapq.heappop(heap)
+			if max_distance is not None and distance > max_distance:
+				break
+			if is_point:
+				found.append((item, distance))
+				continue
+			for node in item.nodes:
+				if node.item not in seen:
+					seen.add(node.item)
+					heapq.heappush(heap, (_point_distance(self.xs[node.item], self.ys[node.item], x, y), 1, counter, node.item))
+					counter += 1
+			for child in item.children:
+				half_width = child.width / 2.0 + 0.5
+				half_height = child.height / 2.0 + 0.5
+				box = (child.center[0] - half_width, child.center[1] - half_height, child.center[0] + half_width, child.center[1] + half_height)
+				heapq.heappush(heap, (_box_distance(box, x, y), 0, counter, child))
+				counter += 1
+		return found
+
+class _GridBackend(object):
+	'''
+	Index backend hashing points into square cells of side cell_size.
+
+	Queries are cheapest when cell_size is close to the query radius; if no cell_size is
+	given, the radius of the first query is used.
+	'''
+	def __init__(self, xs, ys, cell_size=None):
+		self.xs = xs
+		self.ys = ys
+		self.alive = np.ones(len(xs), dtype=bool)
+		self.cells = None
+		self._sorted = None
+		if cell_size:
+			self._build(cell_size)
+
+	def _build(self, cell_size):
+		self.cell_size = float(cell_size)
+		self.cells = {}
+		self._sorted = None
+		slots = np.flatnonzero(self.alive)
+		cxs = np.floor(self.xs[slots] / self.cell_size).astype(np.int64).tolist()
+		cys = np.floor(self.ys[slots] / self.cell_size).astype(np.int64).tolist()
+		for slot, cell in zip(slots.tolist(), zip(cxs, cys)):
+			self.cells.setdefault(cell, []).append(slot)
+
+	def remove(self, slot):
+		self.alive[slot] = False
+		if self.cells is not None:
+			cell = self._cell(self.xs.item(slot), self.ys.item(slot))
+			self.cells[cell].remove(slot)
+			if not self.cells[cell]:
+				del self.cells[cell]
+			self._sorted = None
+
+	def move(self, slot, x, y):
+		if self.cells is not None:
+			old_cell = self._cell(self.xs.item(slot), self.ys.item(slot))
+			new_cell = self._cell(x, y)
+			if old_cell != new_cell:
+				self.cells[old_cell].remove(slot)
+				if not self.cells[old_cell]:
+					del self.cells[old_cell]
+				self.cells.setdefault(new_cell, []).append(slot)
+			self._sorted = None
+		self.xs[slot] = x
+		self.ys[slot] = y
+
+	def _cell(self, x, y):
+		return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+	def nearby(self, x, y, distance):
+		if self.cells is None:
+			self._build(distance if distance > 0 else 1)
+		min_cx, min_cy = self._cell(x - distance, y - distance)
+		max_cx, max_cy = self._cell(x + distance, y + distance)
+		candidates = []
+		if (max_cx - min_cx + 1) * (max_cy - min_cy + 1) > len(self.cells):
+			for (cx, cy), slots in self.cells.iteritems():
+				if min_cx <= cx <= max_cx and min_cy <= cy <= max_cy:
+					candidates.extend(slots)
+		else:
+			for cx in xrange(min_cx, max_cx + 1):
+				for cy in xrange(min_cy, max_cy + 1):
+					slots = self.cells.get((cx, cy))
+					if slots:
+						candidates.extend(slots)
+		return _filter_within(candidates, self.xs, self.ys, x, y, distance)
+
+	def nearest(self, x, y, k, max_distance):
+		if self.cells is None:
+			self._build(_default_cell_size(self.xs, self.ys))
+		if not self.cells:
+			return []
+		_, _, min_cx, min_cy, rows = self._sorted_cells()
+		max_cx = max(cx for cx, _ in self.cells)
+		cx, cy = self._cell(x, y)
+		# no occupied cell is farther than last_ring rings from the query cell
+		last_ring = max(abs(cx - min_cx), abs(cx - max_cx), abs(cy - min_cy), abs(cy - (min_cy + rows - 1)))
+		found = []
+		for ring in xrange(last_ring + 1):
+			# cells in ring r are at least (r - 1) * cell_size away from the query
+			bound = (ring - 1) * self.cell_size
+			if len(found) >= k and found[k - 1][1] <= bound:
+				break
+			if max_distance is not None and bound > max_distance:
+				break
+			if (2 * ring + 1) ** 2 > 4 * len(self.cells):
+				# the remaining rings cover most of the grid, so finish with a full scan
+				return _nearest_among(np.flatnonzero(self.alive), self.xs, self.ys, x, y, k, max_distance)
+			slots = []
+			for cell in _ring_cells(cx, cy, ring):
+				slots.extend(self.cells.get(cell, ()))
+			found = sorted(found + _nearest_among(slots, self.xs, self.ys, x, y, k, max_distance), key=lambda pair: pair[1])[:k]
+		return found
+
+	def _sorted_cells(self):
+		'''
+		Returns the points sorted by cell as (cell keys, slots, min_cx, min_cy, rows), where
+		the key of cell (cx, cy) is (cx - min_cx) * rows + (cy - min_cy).
+		'''
+		if self._sorted is None:
+			slots = np.array([slot for cell_slots in self.cells.itervalues() for slot in cell_slots], dtype=np.int64)
+			cxs = np.floor(self.xs[slots] / self.cell_size).astype(np.int64)
+			cys = np.floor(self.ys[slots] / self.cell_size).astype(np.int64)
+			min_cx, min_cy = (cxs.min(), cys.min()) if len(slots) else (0, 0)
+			rows = (cys.max() - min_cy + 1) if len(slots) else 1
+			keys = (cxs - min_cx) * rows + (cys - min_cy)
+			order = np.argsort(keys, kind='mergesort')
+			self._sorted = (keys[order], slots[order], min_cx, min_cy, rows)
+		return self._sorted
+
+	def nearby_many(self, xs, ys, distance):
+		if self.cells is None:
+			self._build(distance if distance > 0 else 1)
+		reach = int(math.ceil(distance / self.cell_size))
+		if (2 * reach + 1) ** 2 > 4 * max(len(self.cells), 1):
+			# the radius spans most of the grid, so cell lookups would not prune anything
+			return _nearby_many_by_query(self, xs, ys, distance)
+		keys, sorted_slots, min_cx, min_cy, rows = self._sorted_cells()
+		columns = (keys[-1] // rows + 1) if len(keys) else 0
+		query_ids = []
+		slots = []
+		for chunk_start in xrange(0, len(xs), NEARBY_MANY_CHUNK):
+			chunk = np.arange(chunk_start, min(chunk_start + NEARBY_MANY_CHUNK, len(xs)))
+			qcxs = np.floor(xs[chunk] / self.cell_size).astype(np.int64) - min_cx
+			qcys = np.floor(ys[chunk] / self.cell_size).astype(np.int64) - min_cy
+			for dx in xrange(-reach, reach + 1):
+				for dy in xrange(-reach, reach + 1):
+					cxs = qcxs + dx
+					cys = qcys + dy
+					valid = (cxs >= 0) & (cxs < columns) & (cys >= 0) & (cys < rows)
+					cell_keys = cxs[valid] * rows + cys[valid]
+					starts = np.searchsorted(keys, cell_keys, side='left')
+					counts = np.searchsorted(keys, cell_keys, side='right') - starts
+					query_ids.append(np.repeat(chunk[valid], counts))
+					slots.append(sorted_slots[_expand_ranges(starts, counts)])
+		return _pairs_within(xs, ys, self.xs, self.ys, query_ids, slots, distance)
+
+class _KDTreeBackend(object):
+	'''
+	Index backend over a static KD-tree.
+
+	Nodes are kept in flat lists: node i covers slots order[node_start[i]:node_end[i]]
+	inside the bounding box node_bounds[i]; internal nodes have children node_left[i]
+	and node_right[i], leaves have -1.
+
+	Removed points are only masked out of in_tree. Moved points are masked out too and
+	kept in a small loose set that every query scans; once it grows past a fraction of
+	the index the tree is rebuilt.
+	'''
+	LEAF_SIZE = 16
+
+	def __init__(self, xs, ys, cell_size=None):
+		self.xs = xs
+		self.ys = ys
+		self.alive = np.ones(len(xs), dtype=bool)
+		self._build()
+
+	def _build(self):
+		self.order = np.flatnonzero(self.alive)
+		self.in_tree = self.alive.copy()
+		self.loose = set()
+		self.node_start = []
+		self.node_end = []
+		self.node_bounds = []
+		self.node_left = []
+		self.node_right = []
+		if len(self.order):
+			self._split_nodes()
+
+	def _split_nodes(self):
+		stack = [(self._add_node(0, len(self.order)), 0, len(self.order))]
+		while stack:
+			node, start, end = stack.pop()
+			if end - start <= self.LEAF_SIZE:
+				continue
+			slots = self.order[start:end]
+			min_x, min_y, max_x, max_y = self.node_bounds[node]
+			coordinates = self.xs[slots] if max_x - min_x >= max_y - min_y else self.ys[slots]
+			self.order[start:end] = slots[np.argsort(coordinates, kind='mergesort')]
+			mid = (start + end) // 2
+			left = self._add_node(start, mid)
+			right = self._add_node(mid, end)
+			self.node_left[node] = left
+			self.node_right[node] = right
+			stack.append((left, start, mid))
+			stack.append((right, mid, end))
+
+	def _add_node(self, start, end):
+		slots = self.order[start:end]
+		self.node_start.append(start)
+		self.node_end.append(end)
+		self.node_bounds.append((self.xs[slots].min(), self.ys[slots].min(), self.xs[slots].max(), self.ys[slots].max()))
+		self.node_left.append(-1)
+		self.node_right.append(-1)
+		return len(self.node_start) - 1
+
+	def _box_distance(self, node, x, y):
+		return _box_distance(self.node_bounds[node], x, y)
+
+	def remove(self, slot):
+		self.alive[slot] = False
+		self.in_tree[slot] = False
+		self.loose.discard(slot)
+
+	def move(self, slot, x, y):
+		self.xs[slot] = x
+		self.ys[slot] = y
+		self.in_tree[slot] = False
+		self.loose.add(slot)
+		if len(self.loose) > max(4 * self.LEAF_SIZE, len(self.order) // 16):
+			self._build()
+
+	def nearby(self, x, y, distance):
+		ranges = []
+		stack = [0] if self.node_start else []
+		while stack:
+			node = stack.pop()
+			if self._box_distance(node, x, y) >= distance:
+				continue
+			if self.node_left[node] < 0:
+				ranges.append(self.order[self.node_start[node]:self.node_end[node]])
+			else:
+				stack.append(self.node_left[node])
+				stack.append(self.node_right[node])
+		slots = np.concatenate(ranges + [np.zeros(0, dtype=np.int64)])
+		slots = np.concatenate([slots[self.in_tree[slots]], np.array(list(self.loose), dtype=np.int64)])
+		dx = self.xs[slots] - x
+		dy = self.ys[slots] - y
+		return slots[np.sqrt(dx * dx + dy * dy) < distance].tolist()
+
+	def nearby_many(self, xs, ys, distance):
+		return _nearby_many_by_query(self, xs, ys, distance)
+
+	def nearest(self, x, y, k, max_distance):
+		# best-first search: nodes are keyed by distance to their bounding box and points by
+		# their own distance, so points come off the heap in order of distance
+		heap = [(_point_distance(self.xs.item(slot), self.ys.item(slot), x, y), 1, slot) for slot in self.loose]
+		if self.node_start:
+			heap.append((0.0, 0, 0))
+		heapq.heapify(heap)
+		found = []
+		while heap and len(found) < k:
+			distance, is_point, item = heapq.heappop(heap)
+			if max_distance is not None and distance > max_distance:
+				break
+			if is_point:
+				found.append((item, distance))
+			elif self.node_left[item] < 0:
+				for slot in self.order[self.node_start[item]:self.node_end[item]].tolist():
+					if self.in_tree[slot]:
+						heapq.heappush(heap, (_point_distance(self.xs.item(slot), self.ys.item(slot), x, y), 1, slot))
+			else:
+				for child in (self.node_left[item], self.node_right[item]):
+					heapq.heappush(heap, (self._box_distance(child, x, y), 0, child))
+		return found
+
+def _point_distance(x1, y1, x2, y2):
+	return math.sqrt((x2 - x1) * (x2 - x1) + (y2 - y1) * (y2 - y1))
+
+def _box_distance(box, x, y):
+	'''
+	Returns the distance from (x, y) to the box (min_x, min_y, max_x, max_y).
+	'''
+	min_x, min_y, max_x, max_y = box
+	dx = max(min_x - x, 0, x - max_x)
+	dy = max(min_y - y, 0, y - max_y)
+	return math.sqrt(dx * dx + dy * dy)
+
+def _ring_cells(cx, cy, ring):
+	'''
+	Yields the grid cells at Chebyshev distance ring from cell (cx, cy).
+	'''
+	if ring == 0:
+		yield (cx, cy)
+		return
+	for dx in xrange(-ring, ring + 1):
+		yield (cx + dx, cy - ring)
+		yield (cx + dx, cy + ring)
+	for dy in xrange(-ring + 1, ring):
+		yield (cx - ring, cy + dy)
+		yield (cx + ring, cy + dy)
+
+def _nearest_among(slots, xs, ys, x, y, k, max_distance):
+	'''
+	Returns up to k (slot, distance) pairs for the slots closest to (x, y), nearest first.
+	'''
+	if not len(slots):
+		return []
+	slots = np.asarray(slots, dtype=np.int64)
+	dx = xs[slots] - x
+	dy = ys[slots] - y
+	distances = np.sqrt(dx * dx + dy * dy)
+	order = np.argsort(distances, kind='mergesort')[:k]
+	if max_distance is not None:
+		order = order[distances[order] <= max_distance]
+	return zip(slots[order].tolist(), distances[order].tolist())
+
+def _default_cell_size(xs, ys):
+	'''
+	Returns a grid cell size giving a few points per cell on average.
+	'''
+	if len(xs) == 0:
+		return 1.0
+	area = (xs.max() - xs.min()) * (ys.max() - ys.min())
+	return max(math.sqrt(4 * area / len(xs)), 1.0)
+
+def _filter_within(slots, xs, ys, x, y, distance):
+	'''
+	Returns the slots whose point is strictly closer than distance to (x, y).
+	'''
+	if not slots:
+		return []
+	slots = np.array(slots, dtype=np.int64)
+	dx = xs[slots] - x
+	dy = ys[slots] - y
+	return slots[np.sqrt(dx * dx + dy * dy) < distance].tolist()
+
+# number of query points handled per vectorized step of nearby_many, to bound memory
+NEARBY_MANY_CHUNK = 8192
+
+def _expand_ranges(starts, counts):
+	'''
+	Returns the concatenation of arange(start, start + count) over starts and counts.
+	'''
+	total = counts.sum()
+	if total == 0:
+		return np.zeros(0, dtype=np.int64)
+	run_starts = np.cumsum(counts) - counts
+	return np.arange(total) + np.repeat(starts - run_starts, counts)
+
+def _pairs_within(query_xs, query_ys, xs, ys, query_ids, slots, distance):
+	'''
+	Filters candidate (query, slot) pairs to those strictly within distance, and returns
+	them grouped by query as (offsets, slots, distances).
+	'''
+	query_ids = np.concatenate(query_ids + [np.zeros(0, dtype=np.int64)])
+	slots = np.concatenate(slots + [np.zeros(0, dtype=np.int64)])
+	dx = xs[slots] - query_xs[query_ids]
+	dy = ys[slots] - query_ys[query_ids]
+	distances = np.sqrt(dx * dx + dy * dy)
+	within = distances < distance
+	query_ids, slots, distances = query_ids[within], slots[within], distances[within]
+	order = np.argsort(query_ids, kind='mergesort')
+	offsets = np.zeros(len(query_xs) + 1, dtype=np.int64)
+	offsets[1:] = np.cumsum(np.bincount(query_ids, minlength=len(query_xs)))
+	return offsets, slots[order], distances[order]
+
+def _nearby_many_by_query(backend, xs, ys, distance):
+	'''
+	Implements nearby_many with one nearby call per query point.
+	'''
+	query_ids = []
+	slots = []
+	for i, (x, y) in enumerate(zip(xs.tolist(), ys.tolist())):
+		found = backend.nearby(x, y, distance)
+		query_ids.append(np.full(len(found), i, dtype=np.int64))
+		slots.append(np.array(found, dtype=np.int64))
+	return _pairs_within(xs, ys, backend.xs, backend.ys, query_ids, slots, distance)
+
+def _query_arrays(points):
+	'''
+	Returns x and y arrays for query points given as objects with x and y attributes or
+	as an array of shape (n, 2).
+	'''
+	if isinstance(points, np.ndarray):
+		return np.ascontiguousarray(points[:, 0], dtype=np.float64), np.ascontiguousarray(points[:, 1], dtype=np.float64)
+	xs = np.array([point.x for point in points], dtype=np.float64)
+	ys = np.array([point.y for point in points], dtype=np.float64)
+	return xs, ys
+
+INDEX_BACKENDS = {
+	'quadtree': _QuadtreeBackend,
+	'grid': _GridBackend,
+	'kdtree': _KDTreeBackend,
+}
 
 class Index(object):
-	def __init__(self, points):
+	def __init__(self, points, backend='quadtree', cell_size=None):
 		'''
 		Create an index over the specified points.
 		
-		Each element must have x and y attributes.
+		Each element must have x and y attributes; alternatively points may be an array of
+		shape (n, 2), in which case queries return its rows.
+
+		backend selects the spatial structure used to answer queries:
+		- 'quadtree': a pyqtree quadtree (the default).
+		- 'grid': a uniform grid hash. Queries are fastest when cell_size is close to the
+		  query radius; by default the radius of the first query is used.
+		- 'kdtree': a static KD-tree, which copes best with uneven point density and
+		  varying query radii.
 		'''
-		# compute bounding box
-		r = get_empty_rectangle()
-		for point in points:
-			r.extend_to_contain(point)
-		self.index = pyqtree.Index(bbox=(r.min_point.x - 1, r.min_point.y - 1, r.max_point.x + 1, r.max_point.y + 1))
-		
-		# insert points into index, with bounding box being unit square around the point
-		for point in points:
-			self.index.insert(point, (point.x - 0.5, point.y - 0.5, point.x + 0.5, point.y + 0.5))
+		if backend not in INDEX_BACKENDS:
+			raise ValueError('unknown index backend {!r}, expected one of {}'.format(backend, sorted(INDEX_BACKENDS)))
+		if isinstance(points, np.ndarray):
+			self.points = points
+		else:
+			self.points = list(points)
+		self.xs, self.ys = _query_arrays(self.points)
+		self.backend = INDEX_BACKENDS[backend](self.xs, self.ys, cell_size)
+		self.alive = np.ones(len(self.xs), dtype=bool)
+		self.count = len(self.xs)
+		self._slots = None
+
+	def __len__(self):
+		'''
+		Returns the number of points currently in the index.
+		'''
+		return self.count
+
+	def index_of(self, point):
+		'''
+		Returns the position in self.points of the indexed object point.
+		'''
+		if self._slots is None:
+			self._slots = dict((id(indexed), slot) for slot, indexed in enumerate(self.points))
+		return self._slots[id(point)]
+
+	def remove(self, point):
+		'''
+		Removes point from the index, so that queries no longer return it.
+		'''
+		self.remove_index(self.index_of(point))
+
+	def remove_index(self, slot):
+		'''
+		Removes the point at position slot of self.points from the index.
+		'''
+		if not self.alive[slot]:
+			raise KeyError('point {} has already been removed from the index'.format(slot))
+		self.backend.remove(slot)
+		self.alive[slot] = False
+		self.count -= 1
+
+	def move(self, point, new_xy):
+		'''
+		Moves point to new_xy = (x, y), updating both the index and point.x and point.y.
+		'''
+		point.x, point.y = float(new_xy[0]), float(new_xy[1])
+		self.move_index(self.index_of(point), new_xy)
+
+	def move_index(self, slot, new_xy):
+		'''
+		Moves the point at position slot of self.points to new_xy = (x, y) in the index.
+
+		If the index was built over a coordinate array, the array row is updated as well.
+		'''
+		if not self.alive[slot]:
+			raise KeyError('point {} has been removed from the index'.format(slot))
+		x, y = float(new_xy[0]), float(new_xy[1])
+		self.backend.move(slot, x, y)
+		if isinstance(self.points, np.ndarray):
+			self.points[slot, 0] = x
+			self.points[slot, 1] = y
 	
 	def nearby(self, point, distance):
 		'''
 		Returns points in the index that are within distance to the specified point.
 		'''
-		# convert to Point object in case something else is provided (for distance_to function)
-		point = Point(point.x, point.y, 0)
-		
-		# filter points
-		candidates = self.index.intersect((point.x - distance, point.y - distance, point.x + distance, point.y + distance))
-		return [candidate for candidate in candidates if point.distance_to(candidate) < distance]
+		return [self.points[slot] for slot in self.backend.nearby(float(point.x), float(point.y), distance)]
+
+	def nearby_many(self, points, distance):
+		'''
+		Finds the indexed points within distance of each of many query points at once.
+
+		points is a sequence of objects with x and y attributes, or an array of shape (n, 2).
+		Returns (offsets, indices, distances): the neighbors of query i are
+		self.points[j] for j in indices[offsets[i]:offsets[i + 1]], at the corresponding
+		distances. Neighbors of one query are in no particular order.
+		'''
+		xs, ys = _query_arrays(points)
+		return self.backend.nearby_many(xs, ys, distance)
+
+	def nearest(self, point, k=1, max_distance=None):
+		'''
+		Returns the k points in the index closest to the specified point, nearest first.
+
+		Points farther than max_distance are never returned, so fewer than k points may come
+		back. The search is best-first, so only the part of the index near the point is
+		examined.
+		'''
+		indices, _ = self.nearest_indices(point, k, max_distance)
+		return [self.points[slot] for slot in indices]
+
+	def nearest_indices(self, point, k=1, max_distance=None):
+		'''
+		Like nearest, but returns the positions of the points in self.points and their
+		distances as two arrays.
+		'''
+		found = self.backend.nearest(float(point.x), float(point.y), k, max_distance)
+		indices = np.array([slot for slot, _ in found], dtype=np.int64)
+		distances = np.array([distance for _, distance in found], dtype=np.float64)
+		return indices, distances
+
+class BearingIndex(object):
+	def __init__(self, points, sectors=8, backend='grid', cell_size=None):
+		'''
+		Create an index over points that have a bearing, such as Point or PointWithID.
+
+		Points are split into sectors equal bearing sectors, each with its own spatial Index
+		(see Index for backend and cell_size), so a query only visits the sectors its
+		bearing range overlaps.
+		'''
+		self.points = list(points)
+		self.sector_width = 360.0 / sectors
+		bearings = np.array([point.bearing for point in self.points], dtype=np.float64)
+		point_sectors = np.floor((bearings % 360) / self.sector_width).astype(np.int64) % sectors
+		self.sector_indexes = []
+		self.sector_bearings = []
+		for sector in xrange(sectors):
+			slots = np.flatnonzero(point_sectors == sector)
+			self.sector_indexes.append(Index([self.points[slot] for slot in slots.tolist()], backend, cell_size))
+			self.sector_bearings.append(bearings[slots])
+		self._sectors = dict((id(point), sector) for point, sector in zip(self.points, point_sectors.tolist()))
+
+	def __len__(self):
+		return sum(len(index) for index in self.sector_indexes)
+
+	def remove(self, point):
+		'''
+		Removes point from the index, so that queries no longer return it.
+		'''
+		self.sector_indexes[self._sectors[id(point)]].remove(point)
+
+	def sectors_within(self, bearing, max_bearing_diff):
+		'''
+		Returns the sectors holding bearings within max_bearing_diff of bearing.
+		'''
+		sectors = len(self.sector_indexes)
+		if max_bearing_diff >= 180:
+			return range(sectors)
+		first = int(math.floor((bearing - max_bearing_diff) / self.sector_width))
+		last = int(math.floor((bearing + max_bearing_diff) / self.sector_width))
+		# sector numbers wrap around at 360 degrees
+		return sorted(set(sector % sectors for sector in xrange(first, last + 1)))
+
+	def nearby(self, point, distance, max_bearing_diff=180):
+		'''
+		Returns points in the index that are within distance to the specified point and
+		whose bearing differs from the point's by at most max_bearing_diff degrees.
+		'''
+		x, y, bearing = float(point.x), float(point.y), float(point.bearing)
+		found = []
+		for sector in self.sectors_within(bearing, max_bearing_diff):
+			index = self.sector_indexes[sector]
+			slots = np.array(index.backend.nearby(x, y, distance), dtype=np.int64)
+			if len(slots):
+				slots = slots[bearing_difference(bearing, self.sector_bearings[sector][slots]) <= max_bearing_diff]
+				found.extend(index.points[slot] for slot in slots.tolist())
+		return found
 
 class Vertex(object):
 	def __init__(self, id, x, y):
@@ -166,12 +1113,62 @@ class Graph(object):
 		return edge
 	
 	def write(self, fname):
+		'''
+		Writes the graph to fname in the text .graph format.
+		'''
+		lines = ["{} {}\n".format(vertex.x, vertex.y) for vertex in self.vertices]
+		lines.append("\n")
+		lines.extend(["{} {}\n".format(edge.src.id, edge.dst.id) for edge in self.edges])
 		with open(fname, 'w') as f:
-			for vertex in self.vertices:
-				f.write("{} {}\n".format(vertex.x, vertex.y))
-			f.write("\n")
-			for edge in self.edges:
-				f.write("{} {}\n".format(edge.src.id, edge.dst.id))
+			f.writelines(lines)
+
+	def write_support(self, fname):
+		'''
+		Writes the support of each edge to fname, a sidecar to the .graph file: one
+		"src dst support" line per edge, in edge order. Edges without a support field
+		are written with support 0.
+		'''
+		lines = ["{} {} {}\n".format(edge.src.id, edge.dst.id, getattr(edge, 'support', 0)) for edge in self.edges]
+		with open(fname, 'w') as f:
+			f.writelines(lines)
+
+	def read_support(self, fname):
+		'''
+		Sets the support field of each edge from a file written by write_support.
+		'''
+		with open(fname, 'r') as f:
+			rows = [line.split() for line in f if line.strip()]
+		if len(rows) != len(self.edges):
+			raise ValueError('{} has support for {} edges, but the graph has {}'.format(fname, len(rows), len(self.edges)))
+		for edge, (src, dst, support) in zip(self.edges, rows):
+			if (int(src), int(dst)) != (edge.src.id, edge.dst.id):
+				raise ValueError('{} does not match edge {} of the graph'.format(fname, edge.id))
+			edge.support = int(support)
+
+	def write_binary(self, fname):
+		'''
+		Writes the graph to fname in the binary graph format (see write_graph_arrays).
+
+		Binary files are fastest to load with CSRGraph.read, which only maps arrays;
+		read_graph still has to build a Vertex and Edge object for every element.
+		'''
+		write_graph_arrays(fname, *self.arrays())
+
+	def arrays(self):
+		'''
+		Returns the graph as arrays (xs, ys, srcs, dsts), with edges in ID order.
+		'''
+		xs = np.array([vertex.x for vertex in self.vertices], dtype=np.float64)
+		ys = np.array([vertex.y for vertex in self.vertices], dtype=np.float64)
+		srcs = np.array([edge.src.id for edge in self.edges], dtype=np.int64)
+		dsts = np.array([edge.dst.id for edge in self.edges], dtype=np.int64)
+		return xs, ys, srcs, dsts
+
+	def freeze(self):
+		'''
+		Returns a CSRGraph snapshot of this graph; later changes to the graph are not seen.
+		'''
+		return CSRGraph.from_graph(self)
 	
 	def bounds(self):
 		r = get_empty_rectangle()
@@ -179,32 +1176,205 @@ class Graph(object):
 			r.extend_to_contain(vertex)
 		return r
 
-def read_graph(fname):
+class CSRGraph(object):
+	'''
+	A frozen, array-backed view of a Graph.
+
+	Vertices are identified by their IDs in the source graph and edges by their edge IDs.
+	The view holds vertex coordinate arrays xs and ys, edge endpoint arrays edge_src and
+	edge_dst, precomputed edge_lengths, and CSR adjacency in both directions: the
+	out-edges of vertex v are out_edge_ids[out_offsets[v]:out_offsets[v + 1]], and
+	likewise for in-edges.
+	'''
+	def __init__(self, xs, ys, srcs, dsts):
+		self.xs = np.asarray(xs, dtype=np.float64)
+		self.ys = np.asarray(ys, dtype=np.float64)
+		self.edge_src = np.asarray(srcs, dtype=np.int64)
+		self.edge_dst = np.asarray(dsts, dtype=np.int64)
+		self.edge_lengths = np.hypot(self.xs[self.edge_dst] - self.xs[self.edge_src], self.ys[self.edge_dst] - self.ys[self.edge_src])
+		self.out_offsets, self.out_edge_ids = _csr_adjacency(self.edge_src, len(self.xs))
+		self.in_offsets, self.in_edge_ids = _csr_adjacency(self.edge_dst, len(self.xs))
+		self._out_lists = None
+
+	@staticmethod
+	def from_graph(graph):
+		return CSRGraph(*graph.arrays())
+
+	@staticmethod
+	def read(fname):
+		'''
+		Reads a text or binary graph file directly into a CSRGraph.
+
+		This is the fast way to load a graph: no per-vertex or per-edge objects are made.
+		'''
+		return CSRGraph(*read_graph_arrays(fname))
+
+	def vertex_count(self):
+		return len(self.xs)
+
+	def edge_count(self):
+		return len(self.edge_src)
+
+	def out_edges(self, vertex_id):
+		return self.out_edge_ids[self.out_offsets[vertex_id]:self.out_offsets[vertex_id + 1]]
+
+	def in_edges(self, vertex_id):
+		return self.in_edge_ids[self.in_offsets[vertex_id]:self.in_offsets[vertex_id + 1]]
+
+	def out_degrees(self):
+		return np.diff(self.out_offsets)
+
+	def in_degrees(self):
+		return np.diff(self.in_offsets)
+
+	def out_lists(self):
+		'''
+		Returns, for each vertex, a list of (edge ID, destination ID, edge length) tuples.
+
+		The lists are built once and reused, since pure-Python traversals index them far
+		faster than they index NumPy arrays.
+		'''
+		if self._out_lists is None:
+			dsts = self.edge_dst.tolist()
+			lengths = self.edge_lengths.tolist()
+			edge_ids = self.out_edge_ids.tolist()
+			offsets = self.out_offsets.tolist()
+			self._out_lists = [[(edge, dsts[edge], lengths[edge]) for edge in edge_ids[offsets[v]:offsets[v + 1]]] for v in xrange(len(offsets) - 1)]
+		return self._out_lists
+
+	def shortest_path_distance(self, src, dst):
+		'''
+		Returns the length of the shortest directed path between two vertex IDs, or None if
+		dst is unreachable from src.
+		'''
+		out_lists = self.out_lists()
+		distances = {src: 0.0}
+		visited = set()
+		queue = [(0.0, src)]
+		while queue:
+			distance, vertex = heapq.heappop(queue)
+			if vertex == dst:
+				return distance
+			if vertex in visited:
+				continue
+			visited.add(vertex)
+			for _, neighbor, length in out_lists[vertex]:
+				candidate = distance + length
+				if candidate < distances.get(neighbor, float('inf')):
+					distances[neighbor] = candidate
+					heapq.heappush(queue, (candidate, neighbor))
+		return None
+
+	def to_graph(self):
+		return graph_from_arrays(self.xs, self.ys, self.edge_src, self.edge_dst)
+
+def _csr_adjacency(endpoints, vertex_count):
+	'''
+	Groups edge IDs by the given endpoint, returning (offsets, edge IDs).
+	'''
+	edge_ids = np.argsort(endpoints, kind='mergesort')
+	offsets = np.zeros(vertex_count + 1, dtype=np.int64)
+	offsets[1:] = np.cumsum(np.bincount(endpoints, minlength=vertex_count))
+	return offsets, edge_ids
+
+def graph_from_arrays(xs, ys, srcs, dsts):
+	'''
+	Builds a Graph from vertex coordinate arrays and edge endpoint arrays.
+
+	This produces the same Graph as calling add_vertex and add_edge in order, without the
+	per-call overhead.
+	'''
 	graph = Graph()
-	with open(fname) as f:
-		section = 'vertices'
-		for line in f:
-			line = line.strip()
-			if section == 'vertices':
-				if line:
-					parts = line.split(' ')
-					graph.add_vertex(float(parts[0]), float(parts[1]))
-				else:
-					section = 'edges'
-			elif line:
-				parts = line.split(' ')
-				src_id = int(parts[0])
-				dst_id = int(parts[1])
-				graph.add_edge(graph.vertices[src_id], graph.vertices[dst_id])
+	# the cyclic garbage collector would otherwise rescan the new objects many times over
+	gc_was_enabled = gc.isenabled()
+	gc.disable()
+	try:
+		vertices = [Vertex(id, x, y) for id, (x, y) in enumerate(zip(xs.tolist(), ys.tolist()))]
+		edges = [Edge(id, vertices[src], vertices[dst]) for id, (src, dst) in enumerate(zip(srcs.tolist(), dsts.tolist()))]
+		for edge in edges:
+			edge.src.out_edges.append(edge)
+			edge.dst.in_edges.append(edge)
+	finally:
+		if gc_was_enabled:
+			gc.enable()
+	graph.vertices = vertices
+	graph.edges = edges
 	return graph
+
+GRAPH_MAGIC = 'GRPH'
+GRAPH_VERSION = 1
+# magic, version, number of vertices, number of edges
+GRAPH_HEADER = struct.Struct('<4sIqq')
+
+def write_graph_arrays(fname, xs, ys, srcs, dsts):
+	'''
+	Writes a graph given as arrays to fname in the binary graph format.
+
+	After the header come the vertex x and y coordinates (float64), then the out-edges in
+	CSR form: per-vertex offsets (int64, one more than the number of vertices), the
+	destination of each edge grouped by source (int32), and the original ID of each
+	of those edges (int32) so that edge order survives a round trip.
+	'''
+	offsets, order = _csr_adjacency(srcs, len(xs))
+	with open(fname, 'wb') as f:
+		f.write(GRAPH_HEADER.pack(GRAPH_MAGIC, GRAPH_VERSION, len(xs), len(srcs)))
+		for array, dtype in [(xs, '<f8'), (ys, '<f8'), (offsets, '<i8'), (dsts[order], '<i4'), (order, '<i4')]:
+			np.ascontiguousarray(array, dtype=dtype).tofile(f)
+
+def read_graph_arrays(fname):
+	'''
+	Reads a graph file in either the text or binary format as (xs, ys, srcs, dsts).
+	'''
+	with open(fname, 'rb') as f:
+		data = f.read()
+	if data[:len(GRAPH_MAGIC)] == GRAPH_MAGIC:
+		_, version, n_vertices, n_edges = GRAPH_HEADER.unpack_from(data)
+		if version != GRAPH_VERSION:
+			raise ValueError('{} has unsupported graph format version {}'.format(fname, version))
+		arrays = []
+		offset = GRAPH_HEADER.size
+		for dtype, count in [('<f8', n_vertices), ('<f8', n_vertices), ('<i8', n_vertices + 1), ('<i4', n_edges), ('<i4', n_edges)]:
+			arrays.append(np.frombuffer(data, dtype=dtype, count=count, offset=offset))
+			offset += arrays[-1].nbytes
+		xs, ys, offsets, csr_dsts, edge_ids = arrays
+		srcs = np.empty(n_edges, dtype=np.int64)
+		dsts = np.empty(n_edges, dtype=np.int64)
+		srcs[edge_ids] = np.repeat(np.arange(n_vertices), np.diff(offsets))
+		dsts[edge_ids] = csr_dsts
+		return xs.astype(np.float64), ys.astype(np.float64), srcs, dsts
+
+	# text format: "x y" lines, a blank line, then "src dst" lines
+	lines = data.replace('\r\n', '\n').split('\n')
+	stripped = [line.strip() for line in lines]
+	try:
+		split = stripped.index('')
+	except ValueError:
+		split = len(lines)
+	vertices = np.fromstring(' '.join(stripped[:split]), dtype=np.float64, sep=' ').reshape(-1, 2)
+	edges = np.fromstring(' '.join(stripped[split + 1:]), dtype=np.int64, sep=' ').reshape(-1, 2)
+	return vertices[:, 0].copy(), vertices[:, 1].copy(), edges[:, 0].copy(), edges[:, 1].copy()
+
+def read_graph(fname):
+	'''
+	Reads a graph written by Graph.write or Graph.write_binary.
+
+	Parsing is array-based for both formats, but building the Vertex and Edge objects
+	dominates the cost, so this is only a few times faster on binary files. Code that can
+	work on arrays should use CSRGraph.read, the fast path, which skips the objects
+	entirely and loads binary graphs an order of magnitude faster than the text reader.
+	'''
+	return graph_from_arrays(*read_graph_arrays(fname))
 	
 def visualize(fname, graphs, traces, points, width):
 	# automatically determine scale based on the bounding box
 	r = get_empty_rectangle()
 	for graph in graphs:
 		r.extend_to_contain_rect(graph.bounds())
-	for trace in traces:
-		r.extend_to_contain_rect(trace.bounds())
+	if isinstance(traces, TraceStore):
+		r.extend_to_contain_rect(traces.bounds())
+	else:
+		for trace in traces:
+			r.extend_to_contain_rect(trace.bounds())
 	for point in points:
 		r.extend_to_contain(point)
 	l = max(r.lengths()[0], r.lengths()[1])
@@ -222,10 +1392,11 @@ def visualize(fname, graphs, traces, points, width):
 			end = convert_coords(edge.dst)
 			drawing.add(drawing.line((start.x, start.y), (end.x, end.y), stroke=svgwrite.rgb(10, 10, 16, '%'), stroke_width=width))
 	for trace in traces:
-		for i in xrange(len(trace.observations) - 1):
-			start = convert_coords(trace.observations[i])
-			end = convert_coords(trace.observations[i + 1])
-			drawing.add(drawing.line((start.x, start.y), (end.x, end.y), stroke=svgwrite.rgb(10, 10, 16, '%'), stroke_width=width))
+		xs, ys = trace.coordinates()
+		pxs = np.trunc((xs - origin.x) * scale).tolist()
+		pys = np.trunc(lengths[1] - (ys - origin.y) * scale).tolist()
+		for i in xrange(len(pxs) - 1):
+			drawing.add(drawing.line((pxs[i], pys[i]), (pxs[i + 1], pys[i + 1]), stroke=svgwrite.rgb(10, 10, 16, '%'), stroke_width=width))
 	for point in points:
 		c = convert_coords(point)
 		drawing.add(drawing.circle(center=(c.x, c.y), r=width, fill='blue'))